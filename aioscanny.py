@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+"""
+aioscanny.py -- asyncio run engine
+
+clickscanny gives every wait its own thread or blocking call: power
+commands over HTTP or serial, polling for scanners to boot, scanimage
+pipes, TIFF writes.  Here one event loop drives them all, so while one
+experiment's scanners power up another's are scanning and a third's images
+are being written.  scanimage runs under asyncio.create_subprocess_exec and
+its output is read without blocking the loop; work with no async interface
+(power manager drivers, SANE device enumeration and probes, TIFF encoding,
+numpy reductions) is handed to the loop's default executor.
+
+Several settings files can be given; each is an experiment with its own
+timetable, power strip and scanners.
+"""
+
+import os
+import re
+import shlex
+import asyncio
+import datetime
+import functools
+import contextlib
+
+import click
+import numpy as np
+import toml
+
+from util import RunSettings, ScannerSettings, PowerSettings, RunData
+import clickscanny
+import cycles
+import devices
+import imageops
+import scheduler
+import tiffstream
+import unsane
+import util
+import watchdog
+import writer
+
+
+def in_executor(func, *args, **kwargs):
+    """Run blocking func(*args, **kwargs) on the loop's executor -> awaitable.
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def wall_time(t):
+    """Event loop time t -> datetime.
+    """
+    loop = asyncio.get_running_loop()
+    return datetime.datetime.now() + datetime.timedelta(
+        seconds = t - loop.time())
+
+
+async def poll_until(probe, timeout, interval = 1, backoff = 1.5,
+                     max_interval = 10):
+    """util.poll_until for the event loop; probe() runs on the executor.
+    """
+    loop = asyncio.get_running_loop()
+    t_end = loop.time() + timeout
+    while True:
+        result = await in_executor(probe)
+        if result:
+            return result
+        t_now = loop.time()
+        if t_now >= t_end:
+            return None
+        await asyncio.sleep(min(interval, t_end - t_now))
+        interval = min(interval * backoff, max_interval)
+
+
+async def perform(step, actions):
+    """cycles.perform on the event loop -> the step's result.
+
+    actions maps POWER_ON, POWER_OFF and SCAN to coroutine functions.
+    """
+    kind, args = step[0], step[1:]
+    if kind == cycles.SLEEP:
+        await asyncio.sleep(args[0])
+    elif kind == cycles.POLL:
+        probe, timeout, interval = args
+        return await poll_until(probe, timeout, interval = interval)
+    elif kind == cycles.CALL:
+        return await in_executor(*args)
+    else:
+        return await actions[kind](*args)
+
+
+async def run_steps(steps, actions):
+    """cycles.run on the event loop -> steps' return value.
+    """
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as e:
+            return e.value
+        result = await perform(step, actions)
+
+
+class AsyncBusArbiter(devices.BusArbiter):
+    """devices.BusArbiter for coroutines: waiting for a bus doesn't block.
+    """
+    def _semaphore(self, bus):
+        if bus not in self._slots:
+            self._slots[bus] = asyncio.Semaphore(self.per_bus)
+        return self._slots[bus]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, device, t0 = None):
+        bus = self.bus(device)
+        if bus is None or not self.per_bus:
+            yield 0.0
+            return
+        loop = asyncio.get_running_loop()
+        t0 = loop.time() if t0 is None else t0
+        slots = self._semaphore(bus)
+        t_wait = loop.time()
+        remaining = t0 + self.max_jitter - loop.time()
+        acquired = True
+        if not slots.locked():
+            await slots.acquire()
+        elif remaining > 0:
+            try:
+                await asyncio.wait_for(slots.acquire(), remaining)
+            except asyncio.TimeoutError:
+                acquired = False
+        else:
+            acquired = False
+        try:
+            yield (loop.time() - t_wait) if acquired else None
+        finally:
+            if acquired:
+                slots.release()
+
+
+class Engine(object):
+    """What the experiments on one event loop share: power manager sessions
+    (one command at a time per strip), the USB identity map and USB bus
+    arbitration.
+    """
+    def __init__(self, per_bus = 1, max_jitter = devices.DEFAULT_MAX_JITTER,
+                 devmap = None):
+        self.devmap = devices.DeviceMap() if devmap is None else devmap
+        self.arbiter = AsyncBusArbiter(per_bus, max_jitter)
+        self._managers = {}
+        self._locks = {}
+
+    async def _power(self, power, func):
+        key = (power.module, power.address, power.username)
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            if key not in self._managers:
+                self._managers[key] = await in_executor(
+                    clickscanny.power_manager, power)
+            await in_executor(func, power, self._managers[key])
+
+    async def power_on(self, power):
+        await self._power(power, clickscanny.power_on)
+
+    async def power_off(self, power):
+        await self._power(power, clickscanny.power_off)
+
+
+# -- scanimage
+
+async def run_scan(device, settings, consume, timeout = None):
+    """Run scanimage, handing its output stream to coroutine consume
+    -> consume's result.
+
+    If that takes more than timeout secs scanimage is killed and
+    watchdog.ScanTimeout raised.
+    """
+    command = unsane.build_commandline(device, settings)
+    proc = await asyncio.create_subprocess_exec(
+        *shlex.split(command), stdout = asyncio.subprocess.PIPE)
+    try:
+        result = await asyncio.wait_for(consume(proc.stdout), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        # the pipe must be read to its end before the process counts as done
+        await proc.communicate()
+        raise watchdog.ScanTimeout(device, timeout)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.communicate()
+        raise
+    retcode = await proc.wait()
+    if retcode:
+        raise RuntimeError("scanimage exited with status {}".format(retcode))
+    return result
+
+
+async def _pnm_token(stream):
+    token = b""
+    while True:
+        c = await stream.read(1)
+        if not c:
+            raise ValueError("truncated PNM header")
+        if c == b"#":
+            while c not in (b"\n", b""):
+                c = await stream.read(1)
+            continue
+        if c.isspace():
+            if token:
+                return token
+            continue
+        token += c
+
+
+async def read_pnm_header(stream):
+    """unsane.read_pnm_header for an asyncio stream -> (shape, dtype).
+    """
+    magic = await _pnm_token(stream)
+    if magic not in (b"P5", b"P6"):
+        raise ValueError("unsupported PNM type {!r}".format(magic))
+    width, height, maxval = [int(await _pnm_token(stream)) for i in range(3)]
+    dtype = "u1" if maxval < 256 else ">u2"
+    if magic == b"P6":
+        return (height, width, 3), dtype
+    return (height, width), dtype
+
+
+async def read_rows(stream, shape, dtype, nrows):
+    """Next nrows image rows from stream -> array.
+    """
+    rowbytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    try:
+        data = await stream.readexactly(nrows * rowbytes)
+    except asyncio.IncompleteReadError:
+        raise RuntimeError("scanimage output ended early")
+    return np.frombuffer(data, dtype = dtype).reshape((nrows,) +
+                                                      tuple(shape[1:]))
+
+
+async def row_blocks(stream, shape, dtype, chunksize = unsane.CHUNKSIZE):
+    """Generate blocks of about chunksize bytes of image rows.
+
+    Each block is a new array, so it may still be being written while the
+    next is read.
+    """
+    rowbytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    rows = max(1, chunksize // rowbytes)
+    done = 0
+    while done < shape[0]:
+        k = min(rows, shape[0] - done)
+        yield await read_rows(stream, shape, dtype, k)
+        done += k
+
+
+async def scan(device, settings, timeout = None):
+    """Scan into memory (as PNM) -> image array (read-only).
+    """
+    async def consume(stream):
+        shape, dtype = await read_pnm_header(stream)
+        return await read_rows(stream, shape, dtype, shape[0])
+    return await run_scan(device, dict(settings, format = "pnm"), consume,
+                          timeout)
+
+
+async def scan_to_file(device, settings, fname, raw = True, description = None,
+                       chunksize = unsane.CHUNKSIZE, timeout = None):
+    """unsane.scan_to_file on the event loop.
+
+    Raw TIFF is copied to fname as it arrives.  Otherwise PNM rows are
+    reduced (if settings ask for grayscale) and written on the executor,
+    one block while the next is read.
+    """
+    if raw:
+        async def consume(stream):
+            with open(fname, "wb") as f:
+                while True:
+                    chunk = await stream.read(chunksize)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            return fname
+        return await run_scan(device, dict(settings, format = "tiff"),
+                              consume, timeout)
+
+    weights = imageops.grayscale_weights(settings)
+
+    async def consume(stream):
+        shape, dtype = await read_pnm_header(stream)
+        gray = weights if len(shape) == 3 else None
+
+        def write(tif, block):
+            if gray:
+                block = imageops.to_grayscale(block, gray)
+            tif.write_rows(block)
+        with tiffstream.StreamingTiffWriter(fname, byteorder = ">") as tif:
+            tif.begin(shape[:2] if gray else shape, dtype,
+                      description = description)
+            pending = None
+            try:
+                async for block in row_blocks(stream, shape, dtype, chunksize):
+                    if pending is not None:
+                        # a timeout mustn't cancel a write already running
+                        await asyncio.shield(pending)
+                    pending = in_executor(write, tif, block)
+            except BaseException:
+                # don't close the file under that write
+                if pending is not None:
+                    await asyncio.wait([pending])
+                raise
+            if pending is not None:
+                await pending
+        return fname
+    return await run_scan(device, dict(settings, format = "pnm"), consume,
+                          timeout)
+
+
+async def scan_averaged(device, settings, passes, variance = False,
+                        chunksize = unsane.CHUNKSIZE, timeout = None):
+    """unsane.scan_averaged on the event loop -> (mean, variance or None).
+    """
+    accumulator = []
+
+    async def consume(stream):
+        shape, dtype = await read_pnm_header(stream)
+        if not accumulator:
+            accumulator.append(imageops.FrameAccumulator(shape, dtype,
+                                                         variance))
+        acc = accumulator[0]
+        row = 0
+        async for block in row_blocks(stream, shape, dtype, chunksize):
+            await in_executor(acc.add_rows, block, row)
+            row += block.shape[0]
+        acc.end_frame()
+    for i in range(passes):
+        await run_scan(device, dict(settings, format = "pnm"), consume,
+                       timeout)
+    acc = accumulator[0]
+    return await in_executor(acc.mean), await in_executor(acc.variance)
+
+
+# -- acquisition
+
+async def finish_writes(futures):
+    """Wait for writes running on the executor -> their results.
+
+    Even if we are cancelled or one write fails, every write is waited for,
+    so no file is left half written under a retry that rewrites it.
+    """
+    try:
+        return await asyncio.shield(asyncio.gather(*futures))
+    finally:
+        if futures:
+            await asyncio.wait(futures)
+
+
+async def acquire_frame(device, settings, fname, keep_raw, description,
+                        rundata = None, writes = None,
+                        transfer = contextlib.nullcontext):
+    """clickscanny.acquire_frame on the event loop -> list of files saved.
+
+    In-memory scans are encoded on the executor.  If writes is a list the
+    write is started and its future appended there instead of awaited, so
+    the next frame can scan meanwhile.  transfer() is an async context
+    manager held around the scanimage transfer only.
+    """
+    passes = int(settings.get("passes", 1))
+    timeout = watchdog.scan_deadline(settings)
+    if passes > 1 or settings.get("pack"):
+        async with transfer():
+            if passes > 1:
+                img, var = await scan_averaged(
+                    device, settings, passes,
+                    variance = bool(settings.get("variance")),
+                    timeout = timeout)
+            else:
+                img = await scan(device, settings, timeout = timeout)
+                var = None
+        bitdepth = None
+        if rundata is not None:
+            await in_executor(rundata.observe_bitdepth, img)
+            bitdepth = rundata.bitdepth
+        saves = [in_executor(writer.save_scan, fname, img, settings = settings,
+                             description = description,
+                             **writer.pack_options(settings, bitdepth))]
+        if var is not None:
+            var = imageops.grayscale_variance(var, settings)
+            saves.append(in_executor(writer.save_scan,
+                                     writer.suffix_fname(fname, "var"), var,
+                                     description = description))
+        if writes is not None:
+            writes += saves
+            return []
+        saved = []
+        for fnames in await finish_writes(saves):
+            saved += fnames
+        return saved
+    if settings.get("grayscale"):
+        keep_raw = False
+    async with transfer():
+        saved = [await scan_to_file(device, settings, fname, raw = keep_raw,
+                                    description = description,
+                                    timeout = timeout)]
+    if settings.get("split_regions") and settings.get("regions"):
+        bitdepth = rundata.bitdepth if rundata is not None else None
+        saved += await in_executor(writer.split_file, fname, settings,
+                                   description,
+                                   **writer.pack_options(settings, bitdepth))
+    return saved
+
+
+async def acquire(device, settings, fname, keep_raw, description,
+                  rundata = None, transfer = contextlib.nullcontext):
+    """clickscanny.acquire on the event loop -> list of files saved.
+    """
+    frames = util.frame_settings(settings)
+    saved = []
+    writes = []
+    try:
+        for (name, frame) in frames:
+            if len(frames) > 1:
+                frame_fname = writer.suffix_fname(fname, name)
+            else:
+                frame_fname = fname
+            saved += await acquire_frame(device, frame, frame_fname,
+                                         keep_raw, description, rundata,
+                                         writes, transfer)
+    except BaseException:
+        # earlier frames may still be being written
+        if writes:
+            await asyncio.wait(writes)
+        raise
+    for fnames in await finish_writes(writes):
+        saved += fnames
+    return saved
+
+
+async def scan_devices(engine, scansettings, rundata, scannerstr,
+                       keep_raw = True, nscanners = 1, device_names = None,
+                       only = None, attempt = 0):
+    """clickscanny.scan on the event loop -> (devices, indices timed out).
+    """
+    jobs, fnames, selected, description = clickscanny.scan_jobs(
+        scansettings, rundata, scannerstr, nscanners = nscanners,
+        device_names = device_names, only = only)
+    t0 = asyncio.get_running_loop().time()
+
+    @contextlib.asynccontextmanager
+    async def bus_slot(device):
+        # held for scanimage transfers only, not while files are written
+        async with engine.arbiter.slot(device, t0) as waited:
+            if waited is None:
+                rundata.log("Scan {} on {} shared its USB bus after {} secs "
+                            "waiting".format(rundata.nscans_completed, device,
+                                             engine.arbiter.max_jitter))
+            yield
+
+    async def work(i):
+        device = jobs[i][0]
+        return await acquire(device, jobs[i][1], fnames[i], keep_raw,
+                             description, rundata,
+                             functools.partial(bus_slot, device))
+
+    outcomes = await asyncio.gather(*(work(i) for i in selected),
+                                    return_exceptions = True)
+    timed_out = clickscanny.report_results(jobs, selected, outcomes, rundata,
+                                           attempt)
+    return [device for (device, settings) in jobs], timed_out
+
+
+# -- experiments
+
+async def run_experiment(engine, settings, scannerstr, delay = 0,
+                         nscanners = 1, maxretries = 3, on_delay = 60,
+                         reset_delay = 30, keep_raw = True,
+                         missed = "compress", basedir = "."):
+    """Carry out one experiment's power/scan cycles -> RunData.
+
+    The report is written next to the scans when the run ends.
+    """
+    run = RunSettings.fromdict(settings["run"])
+    run.delay = delay
+    scanner = ScannerSettings(settings["scanner"])
+    power = PowerSettings.fromdict(settings["power"])
+    rundata = RunData(run, scanner, power)
+    rundata.basedir = basedir
+    loop = asyncio.get_running_loop()
+    timetable = scheduler.Timetable(loop.time() + delay * 60,
+                                    run.interval * 60, run.nscans,
+                                    policy = missed)
+    policy = cycles.CyclePolicy(rundata, timetable,
+                                re.compile(scannerstr, re.IGNORECASE),
+                                engine.devmap, nscanners = nscanners,
+                                maxretries = maxretries, on_delay = on_delay,
+                                reset_delay = reset_delay)
+
+    async def power_on():
+        await engine.power_on(power)
+
+    async def power_off():
+        await engine.power_off(power)
+
+    async def do_scan(devices, only, attempt):
+        return await scan_devices(engine, scanner, rundata, scannerstr,
+                                  keep_raw = keep_raw, nscanners = nscanners,
+                                  device_names = devices, only = only,
+                                  attempt = attempt)
+
+    actions = {cycles.POWER_ON: power_on, cycles.POWER_OFF: power_off,
+               cycles.SCAN: do_scan}
+    nxt = (0, timetable.planned(0))
+    successful = True
+    try:
+        while nxt is not None:
+            slot, t_run = nxt
+            await asyncio.sleep(max(0, t_run - loop.time()))
+            click.echo("{}: cycle {} (slot {})".format(
+                run.experiment, rundata.nscans_completed + 1, slot + 1))
+            await run_steps(policy.cycle(slot,
+                                         wall_time(timetable.planned(slot))),
+                            actions)
+            nxt = policy.next_slot(slot, loop.time())
+    except Exception as e:
+        # don't take the other experiments on this loop down too
+        click.echo("{}: run stopped: {}".format(run.experiment, e))
+        rundata.log("Run stopped: {}".format(e))
+        successful = False
+
+    rundata.t_end = datetime.datetime.now()
+    rundata.successful = successful
+    if rundata.t_start is not None:
+        logfile = rundata.base_fname() + ".log"
+        with open(logfile, "w") as f:
+            f.write(rundata.generate_report())
+        click.echo("Log file saved as: {}".format(logfile))
+    return rundata
+
+
+@click.command()
+@click.option("-d", "--delay",
+              help = "Delay before first scan (mins)",
+              type = click.IntRange(0, 9999),
+              default = 0,
+              show_default = True)
+@click.option("-s", "--scannerstr",
+              multiple = True,
+              help = "String to match on to identify scanners; one for all "
+                     "SETTINGS_FILES or one per file [default: epson]")
+@click.option("-n", "--nscanners",
+              type = click.IntRange(0, 99),
+              default = 1,
+              show_default = True,
+              help = "Number of matching scanners to drive at once (0 = all)")
+@click.option("-r", "--maxretries",
+              type = click.IntRange(0, 5),
+              default = 3,
+              show_default = True)
+@click.option("--on-delay",
+              type = click.IntRange(1, 600),
+              default = 60,
+              show_default = True,
+              help = "Max secs to wait for scanner to boot after power on")
+@click.option("--reset-delay",
+              type = click.IntRange(0, 600),
+              default = 30,
+              show_default = True,
+              help = "Max secs to wait for scanner to reset after a scan")
+@click.option("--missed",
+              type = click.Choice(scheduler.MISSED_POLICIES),
+              default = "compress",
+              show_default = True,
+              help = "What to do with a scan slot missed because of an overrun")
+@click.option("--per-bus",
+              type = click.IntRange(0, 16),
+              default = 1,
+              show_default = True,
+              help = "Max scans at once per USB host controller (0 = no limit)")
+@click.option("--max-jitter",
+              type = click.IntRange(0, 3600),
+              default = devices.DEFAULT_MAX_JITTER,
+              show_default = True,
+              help = "Max secs a scan waits for its USB bus in a time point")
+@click.option("--keep-raw/--no-keep-raw",
+              default = True,
+              show_default = True,
+              help = "Save scanner's TIFF as-is, rather than re-encoding")
+@click.argument("settings_files", nargs = -1, required = True,
+                type = click.Path(exists=True, dir_okay=False))
+def cli(settings_files, delay, scannerstr, nscanners, maxretries, on_delay,
+        reset_delay, missed, per_bus, max_jitter, keep_raw):
+    """Run one or more experiments from a single asyncio event loop."""
+    patterns = list(scannerstr) or ["epson"]
+    if len(patterns) == 1:
+        patterns *= len(settings_files)
+    elif len(patterns) != len(settings_files):
+        raise click.BadParameter("give one scanner string, or one per "
+                                 "settings file", param_hint = "--scannerstr")
+    experiments = [(toml.load(fname), pattern,
+                    os.path.dirname(os.path.abspath(fname)))
+                   for (fname, pattern) in zip(settings_files, patterns)]
+    # check scanner settings up front, not once the other runs are going
+    for (fname, (settings, pattern, basedir)) in zip(settings_files,
+                                                     experiments):
+        try:
+            ScannerSettings(settings["scanner"])
+        except ValueError as e:
+            raise click.ClickException("{}: {}".format(fname, e))
+    engine = Engine(per_bus, max_jitter)
+
+    async def main():
+        return await asyncio.gather(*(
+            run_experiment(engine, settings, pattern, delay = delay,
+                           nscanners = nscanners, maxretries = maxretries,
+                           on_delay = on_delay, reset_delay = reset_delay,
+                           keep_raw = keep_raw, missed = missed,
+                           basedir = basedir)
+            for (settings, pattern, basedir) in experiments))
+
+    results = asyncio.run(main())
+    if not all(rundata.successful for rundata in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -2,54 +2,250 @@
 
 import sys
 import time, datetime
-import threading, sched
 import re
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import toml
-import tifffile as TIFF
 
 from util import (HHMMSS, RunSettings, ScannerSettings, PowerSettings, RunData)
+import util
+import cycles
+import devices
+import imageops
+import scheduler
 import unsane
+import watchdog
+import writer
 
 
+def outlets(powersettings):
+    """Outlet setting may be a single outlet or a list (one per scanner).
+    """
+    if isinstance(powersettings.outlet, (list, tuple)):
+        return list(powersettings.outlet)
+    return [powersettings.outlet]
 
-def power_on(powersettings):
-    click.echo("Powering on")
+def power_manager(powersettings):
     p = powersettings
     mod = __import__(p.module)
-    mgr = mod.__dict__[p.module](p.address, p.username, p.password)
+    return mod.__dict__[p.module](p.address, p.username, p.password)
+
+def power_on(powersettings, mgr = None):
+    click.echo("Powering on")
+    p = powersettings
+    if mgr is None:
+        mgr = power_manager(p)
     mgr.wake_up()
     time.sleep(1)
-    mgr.power_on(p.outlet)
+    for outlet in outlets(p):
+        mgr.power_on(outlet)
+    unsane.registry.invalidate()
 
-def power_off(powersettings):
+def power_off(powersettings, mgr = None):
     click.echo("Powering off")
     p = powersettings
-    mod = __import__(p.module)
-    mgr = mod.__dict__[p.module](p.address, p.username, p.password)
-    mgr.power_off(p.outlet)    
+    if mgr is None:
+        mgr = power_manager(p)
+    for outlet in outlets(p):
+        mgr.power_off(outlet)
+    unsane.registry.invalidate()
+
+def acquire(device, settings, fname, keep_raw, description, rundata = None,
+            queue = None, transfer = contextlib.nullcontext):
+    """Acquisition worker for one device and cycle -> list of files saved.
+
+    If settings list several frames they are all scanned back to back in
+    this power-on window, each to its own file.  Frames acquired into
+    memory go to a writer thread, so the next frame scans while the last
+    one is written.  If queue (a shared writer.WriterQueue) is given, it
+    is used for every frame and reports their files and errors itself.
+    Each scanimage transfer is done inside the context manager transfer()
+    returns.
+    """
+    frames = util.frame_settings(settings)
+    if len(frames) == 1 or queue is not None:
+        saved = []
+        for (name, frame) in frames:
+            if len(frames) > 1:
+                frame_fname = writer.suffix_fname(fname, name)
+            else:
+                frame_fname = fname
+            saved += acquire_frame(device, frame, frame_fname, keep_raw,
+                                   description, rundata, queue, transfer)
+        return saved
+    saved = []
+    with writer.WriterQueue() as queue:
+        for (name, frame) in frames:
+            saved += acquire_frame(device, frame,
+                                   writer.suffix_fname(fname, name),
+                                   keep_raw, description, rundata, queue,
+                                   transfer)
+    for fnames in queue.written:
+        saved += fnames
+    if queue.errors:
+        fname, e = queue.errors[0]
+        raise RuntimeError("writing {} failed: {}".format(fname, e))
+    return saved
+
+def acquire_frame(device, settings, fname, keep_raw, description,
+                  rundata = None, queue = None,
+                  transfer = contextlib.nullcontext):
+    """Acquire and save one frame -> list of files saved.
 
-def scan(scansettings, rundata, scannerstr, test = False, retries=3):
-    click.echo("Scanning...")
-    rundata.nscans_completed += 1
-    rundata.t_lastscan = datetime.datetime.now()
+    Averaged and packed scans are acquired into memory and, if a
+    writer.WriterQueue is given, handed to it (their files are then
+    reported by the queue, not returned).  Anything else is streamed to
+    disk.  Only the scanimage transfer is done inside transfer(); saving
+    and splitting come after it.
+    """
+    passes = int(settings.get("passes", 1))
+    timeout = watchdog.scan_deadline(settings)
+    if passes > 1 or settings.get("pack"):
+        with transfer():
+            if passes > 1:
+                img, var = unsane.scan_averaged(
+                    device, settings, passes,
+                    variance = bool(settings.get("variance")),
+                    timeout = timeout)
+            else:
+                img = unsane.scan(device, dict(settings, format = "pnm"),
+                                  timeout = timeout)
+                var = None
+        bitdepth = None
+        if rundata is not None:
+            rundata.observe_bitdepth(img)
+            bitdepth = rundata.bitdepth
+        save = writer.save_scan if queue is None else queue.put
+        saved = save(fname, img, settings = settings,
+                     description = description,
+                     **writer.pack_options(settings, bitdepth)) or []
+        if var is not None:
+            var = imageops.grayscale_variance(var, settings)
+            saved += save(writer.suffix_fname(fname, "var"), var,
+                          description = description) or []
+        return saved
+    # the scanner's own TIFF can't be kept if it is to be reduced to gray
+    if settings.get("grayscale"):
+        keep_raw = False
+    with transfer():
+        saved = [unsane.scan_to_file(device, settings, fname, raw = keep_raw,
+                                     description = description,
+                                     timeout = timeout)]
+    if settings.get("split_regions") and settings.get("regions"):
+        bitdepth = rundata.bitdepth if rundata is not None else None
+        saved += writer.split_file(fname, settings, description,
+                                   **writer.pack_options(settings, bitdepth))
+    return saved
+
+def scan_jobs(scansettings, rundata, scannerstr, test = False, nscanners = 1,
+              device_names = None, only = None):
+    """Start a time point, or a retry of one -> (jobs, fnames, selected,
+    description).
+
+    jobs are (device, settings) pairs, fnames their files and selected the
+    indices of the jobs to scan now.
+    """
+    if only is None:
+        click.echo("Scanning...")
+        rundata.nscans_completed += 1
+        rundata.t_lastscan = datetime.datetime.now()
+    else:
+        click.echo("Retrying scan...")
     scanner_re = re.compile(scannerstr, re.IGNORECASE)
     if rundata.t_start is None:
         rundata.t_start =  rundata.t_lastscan 
+    description = "Run Date: {}; Run UID: {}".format(
+        rundata.t_start.strftime("%Y-%m-%d"), rundata.UID)
     if test:
-        img = unsane.scan("test", unsane.test_settings)
+        jobs = [("test", unsane.test_settings)]
+    else:
+        if device_names is None:
+            device_names = sorted(filter(scanner_re.match, unsane.get_scanners()))
+        matches = list(device_names)
+        if nscanners:
+            matches = matches[:nscanners]
+        jobs = [(device, scansettings.settings) for device in matches]
+    if len(jobs) == 1:
+        fnames = [rundata.current_fname() + ".tiff"]
     else:
-        devs = unsane.get_scanners()
-        matches = list(filter(scanner_re.match, devs))
-        img = unsane.scan(matches[0], scansettings.settings)
-    TIFF.imsave(rundata.current_fname() + ".tiff", img)
+        fnames = [rundata.device_fname(i) + ".tiff" for i in range(len(jobs))]
+
+    selected = [i for i in range(len(jobs)) if only is None or i in only]
+    return jobs, fnames, selected, description
+
+def report_results(jobs, selected, outcomes, rundata, attempt = 0):
+    """Report each selected job's outcome -> indices of jobs that timed out.
+
+    outcomes holds, for each selected job, the files saved or the exception
+    raised.
+    """
+    timed_out = []
+    for (i, outcome) in zip(selected, outcomes):
+        device = jobs[i][0]
+        if isinstance(outcome, watchdog.ScanTimeout):
+            click.echo("Scan timed out on {}".format(device))
+            rundata.record_timeout(device, outcome.timeout, attempt)
+            timed_out.append(i)
+        elif isinstance(outcome, Exception):
+            click.echo("Scan failed on {}: {}".format(device, outcome))
+            rundata.log("Scan {} failed on {}: {}".format(
+                rundata.nscans_completed, device, outcome))
+        else:
+            for f in outcome:
+                click.echo("File saved as: {} ({})".format(f, device))
     click.echo("Scan completed at: {}".format(rundata.t_lastscan.strftime("%H:%M:%S")))
-    click.echo("File saved as: {}".format(rundata.current_fname() + ".tiff"))
+    return timed_out
 
-def no_op(*args, **kw):
-    return None
+def scan(scansettings, rundata, scannerstr, test = False, retries=3,
+         keep_raw = True, nscanners = 1, device_names = None, only = None,
+         attempt = 0, queue = None, arbiter = None):
+    """Scan on every matching device -> (devices, indices of timed out ones).
 
+    To retry scans that timed out, pass their indices as only; the retry
+    counts as the same time point and writes the same files.  queue is an
+    optional shared writer.WriterQueue for in-memory scans.  arbiter, a
+    devices.BusArbiter, staggers scans that share a USB host controller.
+    """
+    jobs, fnames, selected, description = scan_jobs(
+        scansettings, rundata, scannerstr, test = test, nscanners = nscanners,
+        device_names = device_names, only = only)
+    t0 = time.monotonic()
+
+    @contextlib.contextmanager
+    def bus_slot(device):
+        # held for scanimage transfers only, not while files are written
+        with arbiter.slot(device, t0) as waited:
+            if waited is None:
+                rundata.log("Scan {} on {} shared its USB bus after {} secs "
+                            "waiting".format(rundata.nscans_completed, device,
+                                             arbiter.max_jitter))
+            elif waited >= 1:
+                click.echo("Waited {:.0f} secs for USB bus ({})".format(
+                    waited, device))
+            yield
+
+    def work(i):
+        device = jobs[i][0]
+        transfer = contextlib.nullcontext
+        if arbiter is not None:
+            transfer = lambda: bus_slot(device)
+        return acquire(device, jobs[i][1], fnames[i], keep_raw, description,
+                       rundata, queue, transfer)
+
+    # one acquisition worker per device; devices on different USB buses
+    # start together, the arbiter staggers those on the same one
+    with ThreadPoolExecutor(max_workers = max(1, len(selected))) as pool:
+        futures = [pool.submit(work, i) for i in selected]
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as e:
+            outcomes.append(e)
+    timed_out = report_results(jobs, selected, outcomes, rundata, attempt)
+    return [device for (device, settings) in jobs], timed_out
 
 def all_settings(run, scan, power):
     s = "\nSETTINGS:\n\n"
@@ -84,14 +280,52 @@ def all_settings(run, scan, power):
         type = str,
         help = "String to match on to identify scanner",
         default = "epson")
+@click.option("-n", "--nscanners",
+              type = click.IntRange(0, 99),
+              default = 1,
+              show_default = True,
+              help = "Number of matching scanners to drive at once (0 = all)")
+@click.option("--on-delay",
+              type = click.IntRange(1, 600),
+              default = 60,
+              show_default = True,
+              help = "Max secs to wait for scanner to boot after power on")
+@click.option("--reset-delay",
+              type = click.IntRange(0, 600),
+              default = 30,
+              show_default = True,
+              help = "Max secs to wait for scanner to reset after a scan")
+@click.option("--missed",
+              type = click.Choice(scheduler.MISSED_POLICIES),
+              default = "compress",
+              show_default = True,
+              help = "What to do with a scan slot missed because of an overrun")
+@click.option("--per-bus",
+              type = click.IntRange(0, 16),
+              default = 1,
+              show_default = True,
+              help = "Max scans at once per USB host controller (0 = no limit)")
+@click.option("--max-jitter",
+              type = click.IntRange(0, 3600),
+              default = devices.DEFAULT_MAX_JITTER,
+              show_default = True,
+              help = "Max secs a scan waits for its USB bus in a time point")
+@click.option("--keep-raw/--no-keep-raw",
+              default = True,
+              show_default = True,
+              help = "Save scanner's TIFF as-is, rather than re-encoding")
 @click.argument("settings_file", 
                 type = click.Path(exists=True, dir_okay=False))
-def cli(settings_file, delay, maxretries, scannerstr, test):
+def cli(settings_file, delay, maxretries, scannerstr, test, keep_raw,
+        nscanners, on_delay, reset_delay, missed, per_bus, max_jitter):
     settings = toml.load(settings_file)
 
     run = RunSettings.fromdict(settings["run"])
     run.delay = delay
-    scanner = ScannerSettings(settings["scanner"])
+    try:
+        scanner = ScannerSettings(settings["scanner"])
+    except ValueError as e:
+        raise click.ClickException(str(e))
     power = PowerSettings.fromdict(settings["power"])
 
     rundata = RunData(run, scanner, power)
@@ -106,43 +340,79 @@ def cli(settings_file, delay, maxretries, scannerstr, test):
         return rundata
 
 
-    scheduler = sched.scheduler(time.time, time.sleep)
-
-    for i in range(run.nscans):
-        if i == 0:
-            scheduler.enter(run.delay * 60, 1, no_op)
-            t = threading.Thread(target = scheduler.run)
-            t.start()
-        while not(scheduler.empty()):
-            tnext = scheduler.queue[0][0]
-            tdelta = datetime.timedelta(seconds = tnext - time.time())
-            click.echo("Time until next scan cycle: {}".format(HHMMSS(tdelta)))
-            sys.stdout.write("\033[F")
-            time.sleep(1)
-        if (i + 1) < run.nscans:
-            scheduler.enter(run.interval * 60, 1, no_op)
-            t = threading.Thread(target=scheduler.run)
-            t.start()
-        click.echo()
-        click.echo("\nCycle {}".format(i+1))
-        retries = 0
+    events = scheduler.Scheduler()
+
+    # stable USB identities of this run's scanners, once known
+    devmap = devices.DeviceMap()
+    arbiter = devices.BusArbiter(per_bus, max_jitter)
+
+    t_first = events.clock() + run.delay * 60
+    timetable = scheduler.Timetable(t_first, run.interval * 60, run.nscans,
+                                    policy = missed)
+    policy = cycles.CyclePolicy(rundata, timetable, scanner_re, devmap,
+                                nscanners = nscanners, maxretries = maxretries,
+                                on_delay = on_delay, reset_delay = reset_delay)
+
+    def do_scan(devices, only, attempt):
+        return scan(scanner, rundata, scannerstr, test = test,
+                    keep_raw = keep_raw, nscanners = nscanners,
+                    device_names = devices, only = only, attempt = attempt,
+                    arbiter = arbiter)
+
+    actions = {cycles.POWER_ON: lambda: power_on(power),
+               cycles.POWER_OFF: lambda: power_off(power),
+               cycles.SCAN: do_scan}
+
+    def advance(steps, data, result = None):
+        """Carry out a cycle's steps up to its next pause, which is timed
+        by the scheduler, or its end.
+        """
         while True:
-            power_on(power)
-            time.sleep(30)  # allow scanner to complete its boot cycle
-            devices = unsane.get_scanners()
-            matching_devices = list(filter(scanner_re.match, devices))
-            if len(matching_devices):
+            try:
+                step = steps.send(result)
+            except StopIteration:
                 break
-            if retries > maxretries:
-                click.echo("No scanners found. Max retries reached.")
+            except cycles.NoScanners as e:
+                click.echo(str(e))
                 sys.exit(1)
-            retries += 1
-            click.echo("No scanners found. Resetting power...")
-            power_off(power)
-        scan(scanner, rundata, scannerstr, test = test)
-        time.sleep(30)  # allow scanner to reset
-        power_off(power) 
+            if step[0] == cycles.SLEEP:
+                events.after(step[1], scheduler.WAKE, steps = steps,
+                             data = data)
+                return
+            result = cycles.perform(step, actions)
+        click.echo()
+        nxt = policy.next_slot(data["slot"], events.clock())
+        if nxt is None:
+            return
+        events.at(nxt[1], scheduler.POWER_ON, cycle = data["cycle"] + 1,
+                  slot = nxt[0])
+
+    def on_power_on(event):
         click.echo()
+        click.echo("\nCycle {} (slot {})".format(event.data["cycle"] + 1,
+                                                 event.data["slot"] + 1))
+        slot = event.data["slot"]
+        steps = policy.cycle(slot, events.wall_time(timetable.planned(slot)))
+        advance(steps, event.data)
+
+    def on_wake(event):
+        advance(event.data["steps"], event.data["data"])
+
+    def on_tick(event):
+        wait = events.time_until(scheduler.POWER_ON)
+        if wait is None:
+            return
+        tdelta = datetime.timedelta(seconds = wait)
+        click.echo("Time until next scan cycle: {}".format(HHMMSS(tdelta)))
+        sys.stdout.write("\033[F")
+
+    events.subscribe(scheduler.POWER_ON, on_power_on)
+    events.subscribe(scheduler.WAKE, on_wake)
+    events.subscribe(scheduler.TICK, on_tick)
+
+    events.at(t_first, scheduler.POWER_ON, cycle = 0, slot = 0)
+    events.every(1, scheduler.TICK)
+    events.run()
 
     rundata.t_end = datetime.datetime.now()
     rundata.successful = True
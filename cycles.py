@@ -0,0 +1,222 @@
+"""
+cycles.py -- the power/scan cycle policy shared by the run engines
+
+Each time point of a run goes: power on and wait for the scanners (power
+cycling them if they don't show up), scan, power cycle and rescan any
+scanner that hung, wait for the scanners to go idle, power off.  The
+timetable then says when the next time point is.
+
+clickscanny, unscannyd and aioscanny all follow this policy and differ only
+in how they wait.  So the policy is written as generators that yield steps,
+tuples naming an action and its arguments, and are sent each step's result:
+
+    (POWER_ON,)                         -> None
+    (POWER_OFF,)                        -> None
+    (SLEEP, secs)                       -> None
+    (POLL, probe, timeout, interval)    -> as util.poll_until
+    (CALL, func, *args)                 -> func(*args)
+    (SCAN, devices, only, attempt)      -> (devices scanned, indices timed out)
+
+SCAN is as clickscanny.scan.  run() carries steps out by blocking; an
+engine can carry them out any other way.
+"""
+
+import time
+import datetime
+
+import click
+
+import unsane
+import util
+
+
+POWER_ON = "power_on"
+POWER_OFF = "power_off"
+SLEEP = "sleep"
+POLL = "poll"
+CALL = "call"
+SCAN = "scan"
+
+# secs a scanner is left off when power cycling it to clear a hang
+POWER_CYCLE_PAUSE = 5
+
+# secs enumeration must stay unchanged before we take it as all the
+# scanners, when we don't know how many there are
+SETTLE = 10
+
+
+class NoScanners(RuntimeError):
+    """The scanners didn't show up after power on, even after retries.
+    """
+    pass
+
+
+def perform(step, actions):
+    """Carry out step, blocking -> its result.
+
+    actions maps POWER_ON, POWER_OFF and SCAN to functions taking the
+    step's arguments.
+    """
+    kind, args = step[0], step[1:]
+    if kind == SLEEP:
+        time.sleep(args[0])
+    elif kind == POLL:
+        probe, timeout, interval = args
+        return util.poll_until(probe, timeout, interval = interval)
+    elif kind == CALL:
+        return args[0](*args[1:])
+    else:
+        return actions[kind](*args)
+
+
+def run(steps, actions):
+    """Carry out every step of generator steps -> its return value.
+    """
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as e:
+            return e.value
+        result = perform(step, actions)
+
+
+def identify_scanners(devmap, matches):
+    """Record identities of freshly enumerated devices -> (device names,
+    identities), ordered by identity; identities is None unless all have one.
+    """
+    found = [(devmap.remember(device), device) for device in matches]
+    if not found or any(identity is None for (identity, device) in found):
+        return sorted(matches), None
+    found.sort()
+    try:
+        devmap.save()
+    except (IOError, OSError):
+        pass
+    return ([device for (identity, device) in found],
+            [identity for (identity, device) in found])
+
+
+def find_scanners(scanner_re, devmap, identities, timeout, n = 1):
+    """Steps: wait for scanners after power on -> (device names, identities).
+
+    Once a run's scanners have known identities their current SANE names
+    are read straight from sysfs, skipping the backend enumeration, and
+    returned once they can be opened; otherwise we enumerate and record the
+    identities of what we find.  If sysfs doesn't give the names within
+    half of timeout, enumeration gets the rest.  n = 0 means we don't know
+    how many scanners there are: we take whatever matches once enumeration
+    stops changing, or what matches at timeout.  Devices are returned
+    ordered by identity, so scanner numbering stays the same from cycle to
+    cycle.
+    """
+    t_end = time.monotonic() + timeout
+    if identities:
+        def probe():
+            # USB enumeration comes before the scanner can be opened
+            names = devmap.resolve_all(identities)
+            if names and all(unsane.device_ready(name) for name in names):
+                return names
+            return None
+        names = yield (POLL, probe, timeout / 2, 1)
+        if names:
+            return names, identities
+    if n:
+        probe = unsane.scanners_probe(scanner_re, n)
+    else:
+        probe = unsane.settled_probe(scanner_re, SETTLE)
+    matches = yield (POLL, probe, max(0, t_end - time.monotonic()), 2)
+    if not matches and not n:
+        matches = yield (POLL, unsane.scanners_probe(scanner_re), 0, 2)
+    return (yield (CALL, identify_scanners, devmap, matches or []))
+
+
+class CyclePolicy(object):
+    """How one run's time points are carried out, and when they fall.
+
+    Keeps the identities of the run's scanners from cycle to cycle.  With
+    nscanners = 0 (all matching scanners) the first cycle waits for
+    enumeration to settle, and later cycles wait for as many scanners as
+    it found.
+    """
+    def __init__(self, rundata, timetable, scanner_re, devmap, nscanners = 1,
+                 maxretries = 3, on_delay = 60, reset_delay = 30):
+        self.rundata = rundata
+        self.timetable = timetable
+        self.scanner_re = scanner_re
+        self.devmap = devmap
+        self.nscanners = nscanners
+        self.maxretries = maxretries
+        self.on_delay = on_delay
+        self.reset_delay = reset_delay
+        self.identities = None
+        self.expected = None
+
+    def power_up(self, maxretries):
+        """Steps: power on and wait for the scanners, power cycling up to
+        maxretries more times -> device names.  Raises NoScanners.
+        """
+        n = self.nscanners or self.expected or 0
+        retries = 0
+        while True:
+            yield (POWER_ON,)
+            # start as soon as the scanner has booted; on_delay is a ceiling
+            devices, self.identities = yield from find_scanners(
+                self.scanner_re, self.devmap, self.identities, self.on_delay,
+                n = n)
+            if devices and len(devices) >= n:
+                if not self.nscanners and self.expected is None:
+                    self.expected = len(devices)
+                return devices
+            if retries >= maxretries:
+                raise NoScanners("No scanners found. Max retries reached.")
+            retries += 1
+            click.echo("No scanners found. Resetting power...")
+            yield (POWER_OFF,)
+
+    def cycle(self, slot, planned):
+        """Steps: the time point in timetable slot, planned for datetime
+        planned.
+        """
+        rundata = self.rundata
+        devices = yield from self.power_up(self.maxretries)
+        rundata.record_scan_time(slot, planned, datetime.datetime.now())
+        scanned, timed_out = yield (SCAN, devices, None, 0)
+        # a hung scanner usually recovers after losing power
+        attempt = 0
+        while timed_out and attempt < self.maxretries:
+            attempt += 1
+            click.echo("Power cycling hung scanner(s)...")
+            yield (POWER_OFF,)
+            yield (SLEEP, POWER_CYCLE_PAUSE)
+            try:
+                devices = yield from self.power_up(0)
+            except NoScanners:
+                rundata.log("Scanners missing after power cycle in "
+                            "scan {}".format(rundata.nscans_completed))
+                break
+            scanned, timed_out = yield (SCAN, devices, timed_out, attempt)
+        # allow scanner to reset, but no longer than it needs
+        idle = yield (POLL, unsane.idle_probe(scanned), self.reset_delay, 1)
+        if not idle:
+            rundata.log("Scanner not idle {} secs after scan {}".format(
+                self.reset_delay, rundata.nscans_completed))
+        yield (POWER_OFF,)
+
+    def next_slot(self, slot, now):
+        """After the time point in slot, at time now -> (slot, time) of the
+        next one, or None if the run is over.
+
+        Cycles start on the run's grid, not relative to the last cycle;
+        missed slots are logged.
+        """
+        timetable = self.timetable
+        slot += 1
+        if slot >= timetable.nslots:
+            return None
+        late = now - timetable.planned(slot)
+        nxt = timetable.next_slot(slot, now)
+        if late > timetable.tolerance:
+            self.rundata.log("Slot {} missed by {:.0f} secs (policy: "
+                             "{})".format(slot + 1, late, timetable.policy))
+        return nxt
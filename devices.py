@@ -0,0 +1,279 @@
+"""
+devices.py -- scanner device discovery
+
+Enumerating scanners (a USB and network probe by the SANE backends) takes
+several seconds, so results are cached and only refreshed when they go
+stale or when a power event means the device list has probably changed.
+
+USB scanners also get a stable identity (vendor/product plus serial number
+or physical port) read from sysfs.  Their SANE names, e.g.
+epson2:libusb:001:007, change every time they are power cycled, but the
+identity doesn't, so the current name can be worked out from sysfs alone.
+
+Scanners behind one USB host controller share its bandwidth, so sysfs is
+also used to group devices by controller, and BusArbiter limits how many
+scans run at once on each.
+"""
+
+import os
+import json
+import threading
+import time
+import contextlib
+
+
+# seconds an enumeration stays valid absent any power events
+DEFAULT_TTL = 600
+
+
+class DeviceRegistry(object):
+    """TTL cache in front of a device enumeration function.
+
+    Results are cached per distinct set of arguments to enumerate_func.
+    Lookups from several threads share a single enumeration.  Empty results
+    are not cached.
+    """
+    def __init__(self, enumerate_func, ttl = DEFAULT_TTL):
+        self.enumerate_func = enumerate_func
+        self.ttl = ttl
+        self.nenumerations = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def devices(self, *args, refresh = False):
+        """List of devices, enumerating only if stale or refresh is True.
+        """
+        with self._lock:
+            entry = self._cache.get(args)
+            if (refresh or entry is None or
+                    time.monotonic() - entry[0] > self.ttl):
+                entry = (time.monotonic(), list(self.enumerate_func(*args)))
+                self.nenumerations += 1
+                # an empty list usually means scanners are still booting,
+                # so don't let it stick
+                if entry[1]:
+                    self._cache[args] = entry
+                else:
+                    self._cache.pop(args, None)
+            return list(entry[1])
+
+    def invalidate(self):
+        """Forget cached results, e.g. after a scanner was power cycled.
+        """
+        with self._lock:
+            self._cache.clear()
+
+
+USB_SYSFS = "/sys/bus/usb/devices"
+
+# location of the persistent identity -> device name map
+DEFAULT_DEVICE_MAP = os.path.join(os.path.expanduser("~"), ".unscanny",
+                                  "devices.json")
+
+
+def _read_attr(path, attr):
+    try:
+        with open(os.path.join(path, attr), "r") as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def usb_devices(sysfs = USB_SYSFS):
+    """USB devices from sysfs -> list of dicts (cheap; no device I/O).
+    """
+    found = []
+    try:
+        entries = sorted(os.listdir(sysfs))
+    except OSError:
+        return found
+    for port in entries:
+        path = os.path.join(sysfs, port)
+        vendor = _read_attr(path, "idVendor")
+        if vendor is None or ":" in port:
+            continue            # interfaces, not devices
+        busnum, devnum = _read_attr(path, "busnum"), _read_attr(path, "devnum")
+        if busnum is None or devnum is None:
+            continue
+        found.append({"vendor": vendor,
+                      "product": _read_attr(path, "idProduct"),
+                      "serial": _read_attr(path, "serial"),
+                      "port": port,
+                      "busnum": int(busnum),
+                      "devnum": int(devnum)})
+    return found
+
+
+def usb_identity(info):
+    """Stable identity for a USB device.
+
+    Serial number if the device has one, else its physical port path, which
+    also tells apart two identical scanners on one host.
+    """
+    if info.get("serial"):
+        return "{}:{}:{}".format(info["vendor"], info["product"], info["serial"])
+    return "{}:{}@{}".format(info["vendor"], info["product"], info["port"])
+
+
+def parse_libusb_name(sane_name):
+    """'epson2:libusb:001:007' -> ('epson2:libusb', 1, 7), else None.
+    """
+    parts = sane_name.split(":")
+    if len(parts) < 4 or parts[-3] != "libusb":
+        return None
+    try:
+        return ":".join(parts[:-2]), int(parts[-2]), int(parts[-1])
+    except ValueError:
+        return None
+
+
+class DeviceMap(object):
+    """Persistent map from stable USB identity to current SANE device name.
+
+    One map may be shared by several threads (runs); entries are only
+    touched under its lock.
+    """
+    def __init__(self, fname = DEFAULT_DEVICE_MAP, sysfs = USB_SYSFS):
+        self.fname = fname
+        self.sysfs = sysfs
+        self.entries = {}
+        self._lock = threading.RLock()
+        if fname and os.path.exists(fname):
+            with open(fname, "r") as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        """Write the map, via a temporary file so it is never half written.
+        """
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok = True)
+        tmpname = self.fname + ".tmp"
+        with self._lock:
+            with open(tmpname, "w") as f:
+                json.dump(self.entries, f, indent = 1, sort_keys = True)
+            os.replace(tmpname, self.fname)
+
+    def identify(self, sane_name):
+        """Identity of a libusb SANE device, or None (e.g. network devices).
+        """
+        parsed = parse_libusb_name(sane_name)
+        if parsed is None:
+            return None
+        prefix, busnum, devnum = parsed
+        for info in usb_devices(self.sysfs):
+            if (info["busnum"], info["devnum"]) == (busnum, devnum):
+                return usb_identity(info)
+        return None
+
+    def remember(self, sane_name):
+        """Record sane_name under its identity -> identity or None.
+        """
+        identity = self.identify(sane_name)
+        if identity is not None:
+            prefix = parse_libusb_name(sane_name)[0]
+            with self._lock:
+                self.entries[identity] = {"name": sane_name, "prefix": prefix}
+        return identity
+
+    def resolve(self, identity, usb = None):
+        """Current SANE name for identity, from sysfs alone, or None.
+        """
+        with self._lock:
+            entry = self.entries.get(identity)
+            if entry is None:
+                return None
+            prefix = entry["prefix"]
+        for info in (usb if usb is not None else usb_devices(self.sysfs)):
+            if usb_identity(info) == identity:
+                name = "{}:{:03d}:{:03d}".format(prefix, info["busnum"],
+                                                 info["devnum"])
+                with self._lock:
+                    self.entries[identity] = {"name": name, "prefix": prefix}
+                return name
+        return None
+
+    def resolve_all(self, identities):
+        """Current names for all identities, or None if any is missing.
+        """
+        usb = usb_devices(self.sysfs)
+        names = [self.resolve(identity, usb) for identity in identities]
+        if any(name is None for name in names):
+            return None
+        return names
+
+
+def usb_controller(busnum, sysfs = USB_SYSFS):
+    """Host controller behind USB bus busnum, e.g. '0000:00:14.0'.
+
+    A USB 3 controller has two buses (USB 2 and USB 3 root hubs) that share
+    it; both resolve to the controller's PCI device.  Falls back to the bus
+    itself if sysfs doesn't say.
+    """
+    root = os.path.join(sysfs, "usb{}".format(busnum))
+    if not os.path.exists(root):
+        return "usb{}".format(busnum)
+    return os.path.basename(os.path.dirname(os.path.realpath(root)))
+
+
+def device_bus(sane_name, sysfs = USB_SYSFS):
+    """Host controller of a libusb SANE device, or None (network etc.).
+    """
+    parsed = parse_libusb_name(sane_name)
+    if parsed is None:
+        return None
+    return usb_controller(parsed[1], sysfs)
+
+
+# secs a scan may be held back behind others on its bus
+DEFAULT_MAX_JITTER = 120
+
+
+class BusArbiter(object):
+    """Limits the number of concurrent scans on each USB host controller.
+
+    Scans on different controllers (and non-USB devices) run in parallel;
+    on one controller at most per_bus run at once and the rest wait their
+    turn.  No scan waits more than max_jitter secs past the time point's
+    start, though: then it starts anyway, sharing the bus, so a time point
+    is never spread over more than that.  per_bus of 0 means no limit.
+    """
+    def __init__(self, per_bus = 1, max_jitter = DEFAULT_MAX_JITTER,
+                 sysfs = USB_SYSFS):
+        self.per_bus = per_bus
+        self.max_jitter = max_jitter
+        self.sysfs = sysfs
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def bus(self, device):
+        return device_bus(device, self.sysfs)
+
+    def _semaphore(self, bus):
+        with self._lock:
+            if bus not in self._slots:
+                self._slots[bus] = threading.BoundedSemaphore(self.per_bus)
+            return self._slots[bus]
+
+    @contextlib.contextmanager
+    def slot(self, device, t0 = None):
+        """Hold a scan slot on device's bus for the with block.
+
+        t0 (time.monotonic) is the start of the time point, default now.
+        Yields the secs waited, or None if the wait hit max_jitter and the
+        scan went ahead without a slot.
+        """
+        bus = self.bus(device)
+        if bus is None or not self.per_bus:
+            yield 0.0
+            return
+        t0 = time.monotonic() if t0 is None else t0
+        slots = self._semaphore(bus)
+        t_wait = time.monotonic()
+        acquired = slots.acquire(timeout = max(0, t0 + self.max_jitter -
+                                               time.monotonic()))
+        try:
+            yield (time.monotonic() - t_wait) if acquired else None
+        finally:
+            if acquired:
+                slots.release()
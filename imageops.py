@@ -0,0 +1,198 @@
+"""
+imageops.py -- array operations applied to scans between acquisition and saving
+"""
+
+import threading
+
+import numpy as np
+
+
+class FrameAccumulator(object):
+    """Running sum of frames for multi-pass averaging, updated in place.
+
+    Integer frames are summed exactly in a wider integer type, so memory use
+    is one accumulator plus whatever frame (or row block) is being added.
+    If variance is True a second, float64, accumulator of squares is kept.
+    """
+    def __init__(self, shape, dtype, variance = False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).newbyteorder("=")
+        if self.dtype.kind in "ub" and self.dtype.itemsize <= 2:
+            acctype = np.uint32
+        elif self.dtype.kind in "iu":
+            acctype = np.int64
+        else:
+            acctype = np.float64
+        self.total = np.zeros(self.shape, acctype)
+        self.sumsq = np.zeros(self.shape, np.float64) if variance else None
+        self.n = 0
+
+    @staticmethod
+    def like(frame, variance = False):
+        return FrameAccumulator(frame.shape, frame.dtype, variance)
+
+    def add_rows(self, block, row = 0):
+        """Fold a block of rows, starting at row, into the accumulator.
+        """
+        k = block.shape[0]
+        np.add(self.total[row:row+k], block, out = self.total[row:row+k],
+               casting = "unsafe")
+        if self.sumsq is not None:
+            sq = np.square(block, dtype = np.float64)
+            np.add(self.sumsq[row:row+k], sq, out = self.sumsq[row:row+k])
+
+    def end_frame(self):
+        self.n += 1
+
+    def add(self, frame, chunk_rows = 256):
+        """Fold a whole frame into the accumulator.
+
+        Frame is added in chunks of rows to bound temporary memory.
+        """
+        if frame.shape != self.shape:
+            raise ValueError("frame shape {} doesn't match {}".format(
+                frame.shape, self.shape))
+        for i in range(0, self.shape[0], chunk_rows):
+            self.add_rows(frame[i:i+chunk_rows], i)
+        self.end_frame()
+
+    def mean(self, chunk_rows = 256):
+        """Mean frame in the original dtype (integers rounded to nearest).
+        """
+        if not self.n:
+            raise ValueError("no frames accumulated")
+        out = np.empty(self.shape, self.dtype)
+        for i in range(0, self.shape[0], chunk_rows):
+            total = self.total[i:i+chunk_rows]
+            if self.dtype.kind in "iub":
+                out[i:i+chunk_rows] = (total + self.n // 2) // self.n
+            else:
+                out[i:i+chunk_rows] = total / self.n
+        return out
+
+    def variance(self, chunk_rows = 256):
+        """Per-pixel (population) variance as float32, or None.
+        """
+        if self.sumsq is None or not self.n:
+            return None
+        out = np.empty(self.shape, np.float32)
+        for i in range(0, self.shape[0], chunk_rows):
+            mean = self.total[i:i+chunk_rows] / self.n
+            var = self.sumsq[i:i+chunk_rows] / self.n - np.square(mean)
+            out[i:i+chunk_rows] = np.maximum(var, 0)
+        return out
+
+
+# Rec. 709 luma weights for R, G, B
+GRAY_WEIGHTS = (0.2126, 0.7152, 0.0722)
+
+
+def grayscale_weights(settings):
+    """RGB weights if settings ask for grayscale reduction, else None.
+    """
+    if not settings or not settings.get("grayscale"):
+        return None
+    weights = settings.get("grayscale_weights", GRAY_WEIGHTS)
+    if len(weights) != 3:
+        raise ValueError("grayscale_weights needs 3 values, got {}".format(
+            weights))
+    return tuple(float(w) for w in weights)
+
+
+def to_grayscale(img, weights = GRAY_WEIGHTS, chunk_rows = 256, out = None):
+    """Reduce an RGB image (rows, cols, 3) to one plane of the same dtype.
+
+    Each pixel becomes the weighted sum of its channels, rounded and
+    clipped to the dtype's range for integer types.  Rows are converted in
+    chunks so temporaries stay small whatever the image size.
+    """
+    if img.ndim != 3 or img.shape[2] != 3:
+        raise ValueError("expected an RGB image, got shape {}".format(img.shape))
+    dtype = img.dtype.newbyteorder("=")
+    if out is None:
+        out = np.empty(img.shape[:2], dtype)
+    w = np.asarray(weights, np.float32)
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+    for i in range(0, img.shape[0], chunk_rows):
+        gray = np.dot(img[i:i+chunk_rows].astype(np.float32), w)
+        if dtype.kind in "iu":
+            np.rint(gray, out = gray)
+            np.clip(gray, info.min, info.max, out = gray)
+        out[i:i+chunk_rows] = gray
+    return out
+
+
+def grayscale_variance(var, settings):
+    """Reduce per-channel variance var to match a grayscale mean -> array.
+
+    The mean becomes the weighted sum of its channels (to_grayscale); taking
+    the channels' noise as independent, its variance is the sum of theirs
+    weighted by the squared weights.  var is returned as is unless settings
+    ask for grayscale and var is RGB.
+    """
+    weights = grayscale_weights(settings)
+    if weights is None or var.ndim != 3 or var.shape[2] != 3:
+        return var
+    return to_grayscale(var, [w * w for w in weights])
+
+
+def bit_range(img, chunk_rows = 256):
+    """Bits used by an integer image -> (lowbit, nbits).
+
+    Every sample is a multiple of 2**lowbit and less than 2**nbits, so the
+    image carries nbits - lowbit significant bits.
+    """
+    union, top = 0, 0
+    for i in range(0, img.shape[0], chunk_rows):
+        chunk = img[i:i+chunk_rows]
+        union |= int(np.bitwise_or.reduce(chunk, axis = None))
+        top = max(top, int(chunk.max()))
+    lowbit = (union & -union).bit_length() - 1 if union else 0
+    return lowbit, top.bit_length()
+
+
+class BitDepthProbe(object):
+    """Effective bit depth of a run, worked out from its first few scans.
+
+    Scanners sold as 16-bit typically deliver 12 or so significant bits,
+    either as small values or shifted up with zero low bits.
+    """
+    def __init__(self, nscans = 3):
+        self.nscans = nscans
+        self.nseen = 0
+        self.lowbit = None
+        self.nbits = 0
+        self.itembits = None
+        self._lock = threading.Lock()
+
+    def observe(self, img):
+        """Fold img into the estimate -> True if this settled it.
+        """
+        if self.settled or img.dtype.kind not in "ui":
+            return False
+        lowbit, nbits = bit_range(img)
+        with self._lock:
+            self.lowbit = lowbit if self.lowbit is None else min(self.lowbit,
+                                                                 lowbit)
+            self.nbits = max(self.nbits, nbits)
+            self.itembits = img.dtype.itemsize * 8
+            self.nseen += 1
+            return self.settled
+
+    @property
+    def settled(self):
+        return self.nseen >= self.nscans
+
+    @property
+    def bits(self):
+        """Significant bits per sample, or None before any scan.
+        """
+        if not self.nseen:
+            return None
+        return self.nbits - self.lowbit
+
+    def packable(self):
+        """True if samples carry fewer bits than their storage size.
+        """
+        return self.nseen > 0 and self.bits < self.itembits
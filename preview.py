@@ -0,0 +1,197 @@
+"""
+preview.py -- quick low resolution preview scans
+
+A preview reuses a run's scanner settings at low resolution, so plate
+placement can be checked in seconds rather than with full resolution test
+scans.  Previews are cached, keyed by scanner and settings, and the plate
+regions are drawn on a copy for checking by eye.  The cached preview also
+serves as the reference for drift checks: the shift between it and a later
+scan is measured by FFT phase correlation.
+"""
+
+import os
+import json
+import hashlib
+
+import click
+import numpy as np
+import tifffile as TIFF
+
+import devices
+import regions
+import settings
+import scanfunctions
+
+
+PREVIEW_DPI = 75
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".unscanny",
+                                 "previews")
+
+# settings that only matter for full scans
+FULL_SCAN_KEYS = {"roi", "roi_margin", "split_regions", "passes", "variance",
+                  "pack", "frames", "scan_timeout", "device_info"}
+
+
+def preview_settings(scanner_settings, dpi = PREVIEW_DPI):
+    """Run's scanner settings -> settings for an 8-bit, full bed preview.
+    """
+    s = {key: val for (key, val) in dict(scanner_settings).items()
+         if key not in FULL_SCAN_KEYS}
+    s["resolution"] = dpi
+    s["depth"] = 8
+    return s
+
+
+def cache_key(device, preview_settings):
+    """Key identifying a preview by scanner and settings.
+
+    A libusb device name changes whenever the scanner is power cycled, so
+    the scanner's USB identity is used where it has one.
+    """
+    scanner = devices.DeviceMap(fname = None).identify(device) or device
+    blob = json.dumps({"device": scanner, "settings": preview_settings},
+                      sort_keys = True, default = str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_fname(device, preview_settings, cache_dir = DEFAULT_CACHE_DIR):
+    return os.path.join(cache_dir,
+                        "preview-{}.tif".format(cache_key(device,
+                                                          preview_settings)))
+
+
+def scan_preview(device, preview_settings):
+    """Acquire a preview image on device.
+    """
+    session = scanfunctions.get_session(device)
+    session.configure(preview_settings)
+    return session.arr_scan()
+
+
+def get_preview(device, preview_settings, cache_dir = DEFAULT_CACHE_DIR,
+                refresh = False, scan_func = scan_preview):
+    """Cached preview for device and settings -> (image, fname, was cached).
+    """
+    fname = cache_fname(device, preview_settings, cache_dir)
+    if not refresh and os.path.exists(fname):
+        return TIFF.imread(fname), fname, True
+    img = scan_func(device, preview_settings)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    description = json.dumps({"device": device, "settings": preview_settings},
+                             sort_keys = True, default = str)
+    TIFF.imsave(fname, img, description = description)
+    return img, fname, False
+
+
+def gray(img):
+    """Single float32 plane from a gray or RGB image.
+    """
+    img = np.asarray(img, np.float32)
+    return img.mean(axis = 2) if img.ndim == 3 else img
+
+
+def overlay_regions(img, preview_settings, width = 2):
+    """RGB 8-bit copy of img with the plate regions outlined in red.
+    """
+    plane = gray(img)
+    scale = 255.0 / max(1.0, float(plane.max()))
+    out = np.repeat((plane * scale).astype(np.uint8)[:, :, None], 3, axis = 2)
+    boxes = regions.pixel_regions(preview_settings, plane.shape)
+    for (x0, y0, x1, y1) in boxes.values():
+        if x1 <= x0 or y1 <= y0:
+            continue
+        for (ys, xs) in ((slice(y0, y0 + width), slice(x0, x1)),
+                         (slice(y1 - width, y1), slice(x0, x1)),
+                         (slice(y0, y1), slice(x0, x0 + width)),
+                         (slice(y0, y1), slice(x1 - width, x1))):
+            out[ys, xs] = (255, 0, 0)
+    return out
+
+
+def downsample(img, factor):
+    """Block average a plane by an integer factor.
+    """
+    if factor <= 1:
+        return img
+    h, w = (img.shape[0] // factor) * factor, (img.shape[1] // factor) * factor
+    return img[:h, :w].reshape(h // factor, factor,
+                               w // factor, factor).mean(axis = (1, 3))
+
+
+def phase_correlation(ref, img):
+    """Translation of img relative to ref -> (dy, dx) in pixels.
+
+    Both are cropped to their common shape and windowed to suppress edge
+    effects.  The peak of the normalized cross-power spectrum gives the
+    shift to whole pixels.
+    """
+    h = min(ref.shape[0], img.shape[0])
+    w = min(ref.shape[1], img.shape[1])
+    window = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+    a = (ref[:h, :w] - ref[:h, :w].mean()) * window
+    b = (img[:h, :w] - img[:h, :w].mean()) * window
+    cross = np.fft.rfft2(b) * np.conj(np.fft.rfft2(a))
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    corr = np.fft.irfft2(cross, s = (h, w))
+    dy, dx = np.unravel_index(np.argmax(corr), corr.shape)
+    if dy > h // 2:
+        dy -= h
+    if dx > w // 2:
+        dx -= w
+    return int(dy), int(dx)
+
+
+def measure_drift(ref, img, ref_dpi, dpi):
+    """Drift of img (scanned at dpi) from preview ref -> (dy, dx) in mm.
+    """
+    factor = int(round(float(dpi) / ref_dpi))
+    dy, dx = phase_correlation(gray(ref), downsample(gray(img), factor))
+    return (regions.px2mm(dy, ref_dpi), regions.px2mm(dx, ref_dpi))
+
+
+@click.command()
+@click.option("-d", "--device", default = None,
+              help = "Scanner device name (default: first found)")
+@click.option("--dpi", default = PREVIEW_DPI, show_default = True,
+              type = click.IntRange(25, 300),
+              help = "Preview resolution")
+@click.option("--refresh/--no-refresh", default = False, show_default = True,
+              help = "Scan even if a cached preview exists")
+@click.option("--drift/--no-drift", default = False, show_default = True,
+              help = "Scan now and report drift from the cached preview")
+@click.option("--cache-dir", default = DEFAULT_CACHE_DIR, show_default = True,
+              type = click.Path(file_okay = False))
+@click.argument("scanner_file",
+                type = click.Path(exists=True, dir_okay=False))
+def preview(scanner_file, device, dpi, refresh, drift, cache_dir):
+    """Low resolution preview with plate regions drawn on it."""
+    scanner_settings = settings.load_config(scanner_file, "scanner")
+    s = preview_settings(scanner_settings, dpi)
+    if device is None:
+        if not scanfunctions.driver_initialized():
+            scanfunctions.initialize_driver()
+        scanners = scanfunctions.get_scanners()
+        if not scanners:
+            raise click.ClickException("No scanners found")
+        device = scanners[0][0]
+    try:
+        ref, fname, cached = get_preview(device, s, cache_dir,
+                                         refresh = refresh and not drift)
+        click.echo("Preview {}: {}".format("(cached)" if cached else "saved",
+                                           fname))
+        if drift and not cached:
+            click.echo("No reference preview to compare against; this one "
+                       "is the reference from now on.")
+        elif drift:
+            img = scan_preview(device, s)
+            dy, dx = measure_drift(ref, img, dpi, dpi)
+            click.echo("Drift from reference: {:.2f} mm down, "
+                       "{:.2f} mm right".format(dy, dx))
+    finally:
+        scanfunctions.close_sessions()
+    if s.get("regions"):
+        overlay = os.path.splitext(fname)[0] + "-regions.tif"
+        TIFF.imsave(overlay, overlay_regions(ref, s), photometric = "rgb")
+        click.echo("Regions overlay: {}".format(overlay))
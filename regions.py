@@ -0,0 +1,117 @@
+"""
+regions.py -- plate regions (as in plates.json) and scan geometry
+
+A regions file maps region names to pixel boxes [x0, y0, x1, y1] measured
+on a scan at some reference resolution (regions_dpi).  SANE geometry
+options (tl-x, tl-y, br-x, br-y) are in millimetres, so boxes are
+converted through mm to the scanner, and back to pixels at whatever
+resolution we actually scan at.
+"""
+
+import json
+
+
+MM_PER_INCH = 25.4
+
+# resolution plates.json boxes are measured at, unless settings say otherwise
+DEFAULT_REGIONS_DPI = 300
+
+# scan bed (width, height) in mm by SANE source, and for other sources
+BEDS = {"Flatbed": (215.9, 297.2),
+        "TPU8x10": (203.2, 254.0)}
+DEFAULT_BED = (215.9, 297.2)
+
+
+def load_regions(fname):
+    """Regions JSON file -> dict of name: (x0, y0, x1, y1), sorted by name.
+    """
+    with open(fname, "r") as f:
+        regions = json.load(f)
+    return {name: tuple(regions[name]) for name in sorted(regions)}
+
+
+def union(regions):
+    """Bounding box enclosing all regions -> (x0, y0, x1, y1).
+    """
+    boxes = list(regions.values())
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def px2mm(px, dpi):
+    return px * MM_PER_INCH / dpi
+
+
+def mm2px(mm, dpi):
+    return int(round(mm * dpi / MM_PER_INCH))
+
+
+def bed_size(settings):
+    """Scan bed (width, height) in mm for the source in settings.
+
+    settings["bed_size"] = [width, height] overrides the BEDS table.
+    """
+    if settings.get("bed_size"):
+        width, height = settings["bed_size"]
+        return float(width), float(height)
+    return BEDS.get(settings.get("source"), DEFAULT_BED)
+
+
+def scan_geometry(regions, regions_dpi = DEFAULT_REGIONS_DPI, margin = 0,
+                  bed = None):
+    """SANE geometry options covering all regions, plus margin (mm).
+
+    Given the bed (width, height) in mm, the margin is clipped to it and
+    ValueError raised if the regions themselves don't fit on it.
+    """
+    x0, y0, x1, y1 = (px2mm(v, regions_dpi) for v in union(regions))
+    width, height = bed or (float("inf"), float("inf"))
+    if x1 > width or y1 > height:
+        raise ValueError(
+            "Regions reach {:.1f} x {:.1f} mm, off the {:.1f} x {:.1f} mm "
+            "scan bed; were they measured on a rotated scan, or at other "
+            "than regions_dpi = {}?".format(x1, y1, width, height,
+                                            regions_dpi))
+    return {"tl-x": max(0, x0 - margin),
+            "tl-y": max(0, y0 - margin),
+            "br-x": min(width, x1 + margin),
+            "br-y": min(height, y1 + margin)}
+
+
+def settings_geometry(settings):
+    """Scanner settings -> SANE geometry for the plate area, or {}.
+
+    Hardware region-of-interest scanning is enabled by "roi = true" along
+    with "regions" (path to a regions file) in the scanner settings.
+    Raises ValueError if the regions don't fit on the bed (see bed_size).
+    """
+    if not settings.get("roi") or not settings.get("regions"):
+        return {}
+    return scan_geometry(load_regions(settings["regions"]),
+                         settings.get("regions_dpi", DEFAULT_REGIONS_DPI),
+                         settings.get("roi_margin", 0), bed_size(settings))
+
+
+def pixel_regions(settings, shape = None):
+    """Regions in pixel coordinates of a scan acquired with settings.
+
+    Boxes are rescaled from regions_dpi to the scan resolution and, for ROI
+    scans, shifted so they are relative to the scanned area.  If the image
+    shape is given boxes are clipped to it.
+    """
+    regions = load_regions(settings["regions"])
+    regions_dpi = settings.get("regions_dpi", DEFAULT_REGIONS_DPI)
+    dpi = settings.get("resolution", regions_dpi)
+    geometry = settings_geometry(settings)
+    x_origin = mm2px(geometry.get("tl-x", 0), dpi)
+    y_origin = mm2px(geometry.get("tl-y", 0), dpi)
+    scaled = {}
+    for (name, box) in regions.items():
+        x0, y0, x1, y1 = (mm2px(px2mm(v, regions_dpi), dpi) for v in box)
+        x0, x1 = x0 - x_origin, x1 - x_origin
+        y0, y1 = y0 - y_origin, y1 - y_origin
+        if shape is not None:
+            x0, x1 = (min(max(0, x), shape[1]) for x in (x0, x1))
+            y0, y1 = (min(max(0, y), shape[0]) for y in (y0, y1))
+        scaled[name] = (x0, y0, x1, y1)
+    return scaled
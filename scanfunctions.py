@@ -4,65 +4,388 @@ import time, datetime
 
 import sane
 import numpy as np
-import tifffile as TIFF
+
+import synthscanner
+import watchdog
+from devices import DeviceRegistry, DeviceMap
+from util import device_options, frame_settings
+from writer import save_scan, suffix_fname, pack_options
+from imageops import FrameAccumulator, grayscale_variance
+
+
+_driver_state = {"initialized": False}
 
 
 def initialize_driver():
     """Initialize the scanner driver.
     """
-    return sane.init()
+    version = sane.init()
+    _driver_state["initialized"] = True
+    return version
+
+
+# cached device enumeration; invalidated on power events
+registry = DeviceRegistry(lambda localOnly: sane.get_devices(localOnly))
 
 
-def get_scanners(localOnly=True, test = False):
+def get_scanners(localOnly=True, test = False, refresh = False):
     """Get list of available scanners.
     """
     if test:
         return [("test", "SANE", "SANE", "SANE")]
-    return sane.get_devices(localOnly)
+    synthetic = [(name, "unscanny", "synthetic", "synthetic scanner")
+                 for name in synthscanner.synthetic_devices()]
+    return registry.devices(localOnly, refresh = refresh) + synthetic
 
 
 def open_scanner(device_name):
     """Prepare scanner for scanning.
     """
+    if synthscanner.is_synthetic(device_name):
+        return synthscanner.SyntheticScanner(device_name)
     return sane.open(device_name)
 
 
-def apply_scanner_settings(scanner, settings_dict):
+def option_name(key):
+    """python-sane spells option names with underscores, e.g. tl_x.
+    """
+    return key.replace("-", "_")
+
+
+def apply_scanner_settings(scanner, settings_dict, cache = None):
     """Apply info from Settings object to scanner object.
+
+    If an OptionCache for the device is given, only options whose value
+    differs from the last applied one are written.
     """
+    if cache is not None:
+        cache.apply(scanner, device_options(settings_dict))
+        return scanner
+    options = device_options(settings_dict)
     # mode should always be set first to insure options are active
-    if "mode" in settings_dict:
-        setattr(scanner, "mode", settings_dict["mode"])
-    for (key, value) in settings_dict.iteritems():
-        setattr(scanner, key, value)
+    if "mode" in options:
+        setattr(scanner, "mode", options["mode"])
+    for (key, value) in options.items():
+        if key != "mode":
+            setattr(scanner, option_name(key), value)
     return scanner
 
 
-def fake_scan(scanner, run_data):
+class OptionCache(object):
+    """Option descriptors and last-applied values for one device.
+
+    Every option write is a round trip to the backend and may make the
+    device reconfigure itself, so we remember what was last written and
+    only send changes.  Descriptors are read once (via get_options) and used
+    to validate settings before a run starts, rather than failing mid-run.
+    """
+    def __init__(self, scanner):
+        # (number, name, title, desc, type, unit, size, cap, constraint)
+        self.descriptors = {option_name(opt[1]): opt
+                            for opt in scanner.get_options() if opt[1]}
+        self.applied = {}
+
+    def reset(self):
+        """Forget applied values, e.g. after the device was reopened.
+        """
+        self.applied.clear()
+
+    def validate(self, options):
+        """Raise ValueError describing any unknown option or bad value.
+        """
+        problems = []
+        for (key, value) in options.items():
+            name = option_name(key)
+            if name not in self.descriptors:
+                problems.append("unknown option '{}'".format(key))
+                continue
+            constraint = self.descriptors[name][8]
+            if isinstance(constraint, tuple) and len(constraint) == 3:
+                low, high = constraint[0], constraint[1]
+                if not low <= value <= high:
+                    problems.append("{} = {} outside range {}-{}".format(
+                        key, value, low, high))
+            elif isinstance(constraint, list) and value not in constraint:
+                problems.append("{} = {} not one of {}".format(
+                    key, value, constraint))
+        if problems:
+            raise ValueError("Invalid scanner settings: " + "; ".join(problems))
+
+    def apply(self, scanner, options):
+        """Write only changed options (mode first) -> list of keys written.
+        """
+        written = []
+        if "mode" in options and self.applied.get("mode") != options["mode"]:
+            setattr(scanner, "mode", options["mode"])
+            # a mode change can reset other options in the backend
+            self.applied = {"mode": options["mode"]}
+            written.append("mode")
+        for (key, value) in options.items():
+            name = option_name(key)
+            if name == "mode" or self.applied.get(name) == value:
+                continue
+            setattr(scanner, name, value)
+            self.applied[name] = value
+            written.append(key)
+        return written
+
+
+class ScannerSession(object):
+    """Keep the SANE driver initialized and a device open across scan cycles.
+
+    Starting the driver and opening the device takes seconds, so a session
+    holds on to both while the scanner stays powered.  A cheap liveness
+    check is run before each scan and the device is reopened (and its
+    settings reapplied) only after a power cycle or an error.
+    """
+    def __init__(self, device_name, settings = None):
+        self.device_name = device_name
+        self.settings = settings
+        self.scanner = None
+        self.options = None
+        self.nopens = 0
+        self.identity = None
+        self.devmap = None
+
+    def open(self):
+        """Initialize driver (once) and open device if not already open.
+        """
+        if not driver_initialized():
+            initialize_driver()
+        if self.scanner is None:
+            self.follow()
+            self.scanner = open_scanner(self.device_name)
+            self.nopens += 1
+            # option descriptors don't change across reopens, values do
+            if self.options is None:
+                self.options = OptionCache(self.scanner)
+            self.options.reset()
+            if self.settings:
+                self.options.validate(device_options(self.settings))
+                apply_scanner_settings(self.scanner, self.settings,
+                                       self.options)
+        return self.scanner
+
+    def configure(self, settings):
+        """Validate settings, record them and apply them to the open device.
+
+        Raises ValueError if the device doesn't support the settings.
+        """
+        if self.is_alive():
+            self.options.validate(device_options(settings))
+            self.settings = settings
+            apply_scanner_settings(self.scanner, settings, self.options)
+        else:
+            self.settings = settings
+            self.invalidate()
+
+    def is_alive(self):
+        """Liveness check -- query scan parameters without scanning.
+        """
+        if self.scanner is None:
+            return False
+        try:
+            self.scanner.get_parameters()
+        except Exception:
+            return False
+        return True
+
+    def invalidate(self):
+        """Drop the device handle, e.g. after the scanner lost power.
+        """
+        if self.scanner is not None:
+            try:
+                self.scanner.close()
+            except Exception:
+                pass
+        self.scanner = None
+
+    def power_cycled(self):
+        """Scanner lost power: drop the handle and the cached device list.
+
+        A libusb device comes back under a new name, so its USB identity is
+        noted to find it again by.
+        """
+        if self.devmap is None:
+            self.devmap = DeviceMap(fname = None)
+            self.identity = self.devmap.remember(self.device_name)
+        self.invalidate()
+        registry.invalidate()
+
+    def follow(self):
+        """Update device_name to the scanner's current name, if it is known
+        by USB identity and present.
+        """
+        if self.identity is None:
+            return
+        name = self.devmap.resolve(self.identity)
+        if name is not None:
+            self.device_name = name
+
+    def acquire(self):
+        """Return an open, responsive device, reopening it if necessary.
+        """
+        if not self.is_alive():
+            self.invalidate()
+        return self.open()
+
+    def ready(self):
+        """Readiness probe -- True once the device can be (re)opened.
+        """
+        try:
+            self.acquire()
+        except ValueError:
+            # bad settings, not an unready device
+            raise
+        except Exception:
+            self.invalidate()
+            return False
+        return True
+
+    def arr_scan(self):
+        """Scan to numpy array; a failed scan forces a reopen next time.
+        """
+        scanner = self.acquire()
+        try:
+            return scanner.arr_scan()
+        except Exception:
+            self.invalidate()
+            raise
+
+    def cancel(self):
+        """Cancel a scan in progress (from another thread) and drop the handle.
+
+        The handle is not closed, since closing a hung device can block too.
+        """
+        scanner, self.scanner = self.scanner, None
+        if scanner is not None:
+            scanner.cancel()
+
+    def close(self):
+        self.invalidate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_sessions = {}
+
+
+def driver_initialized():
+    return _driver_state["initialized"]
+
+
+def get_session(device_name):
+    """Return the persistent session for device_name, creating it if needed.
+    """
+    if device_name not in _sessions:
+        _sessions[device_name] = ScannerSession(device_name)
+    return _sessions[device_name]
+
+
+def close_sessions():
+    """Close all open sessions and shut down the SANE driver.
+    """
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
+    if driver_initialized():
+        sane.exit()
+        _driver_state["initialized"] = False
+
+
+def fake_scan(scanner, run_data, writer = None):
     """A function for testing program logic w/out actually scanning.
+
+    Goes through the normal scan and save path with a synthetic scanner
+    standing in for the real one.
     """
     t_now = datetime.datetime.now()
     print("Scanning at {}".format(t_now.ctime()))
-    run_data.t_lastscan = t_now()
-    run_data.ct_nextscan += 1
-    return run_data
+    synthetic = synthscanner.SyntheticScanner()
+    apply_scanner_settings(synthetic, run_data.scanner_settings)
+    return scan(synthetic, run_data, writer)
+
+
+def arr_scan(scanner, timeout):
+    """scanner.arr_scan(), cancelled if it takes longer than timeout secs.
+
+    Raises watchdog.ScanTimeout on timeout.
+    """
+    return watchdog.call_with_deadline(
+        scanner.arr_scan, timeout, cancel = getattr(scanner, "cancel", None),
+        device = getattr(scanner, "device_name", None))
+
+
+def acquire(scanner, settings):
+    """Acquire a frame -> (image, variance or None).
+
+    If settings ask for passes > 1, that many back-to-back scans are
+    averaged as they arrive; only the accumulator and the latest frame are
+    held in memory.  Per-pixel variance is computed if settings["variance"].
+    Each pass must finish within watchdog.scan_deadline(settings).
+    """
+    passes = max(1, int(settings.get("passes", 1)))
+    timeout = watchdog.scan_deadline(settings)
+    if passes == 1:
+        return arr_scan(scanner, timeout), None
+    frame = arr_scan(scanner, timeout)
+    accumulator = FrameAccumulator.like(frame, bool(settings.get("variance")))
+    for i in range(passes):
+        if i:
+            frame = arr_scan(scanner, timeout)
+        accumulator.add(frame)
+        del frame
+    return accumulator.mean(), accumulator.variance()
+
+
+def configure(scanner, settings):
+    """Apply a frame's settings to a session or to a bare device.
+    """
+    if hasattr(scanner, "configure"):
+        scanner.configure(settings)
+    else:
+        apply_scanner_settings(scanner, settings)
 
 
-def scan(scanner, run_data):
+def scan(scanner, run_data, writer = None):
     """Scan and save image based on run settings.
+
+    If writer (a writer.WriterQueue) is given the image is handed off to it
+    and this returns as soon as acquisition is done.  If the settings list
+    several frames, each is scanned in turn on the open device and saved
+    to its own file.
     """
     # get current time
     t_scan = datetime.datetime.now()
     
     # get current filename, with tif extension
     fname = run_data.current_fname(t_scan) + ".tif"
-    
-    # run scan and save image
-    imgarray = scanner.arr_scan()
     beginstr = run_data.t_start.strftime("%Y-%m-%d")
-    TIFF.imsave(fname, imgarray,
-        description="Run Date: {}; Run UID: {}".format(beginstr,
-                                                       run_data.UID))
+    description = "Run Date: {}; Run UID: {}".format(beginstr, run_data.UID)
+    save = save_scan if writer is None else writer.put
+
+    frames = frame_settings(run_data.scanner_settings)
+    for (name, settings) in frames:
+        if len(frames) > 1:
+            # only changed options are written to the device
+            configure(scanner, settings)
+        frame_fname = fname if name is None else suffix_fname(fname, name)
+
+        # run scan(s) and save image
+        imgarray, variance = acquire(scanner, settings)
+        run_data.observe_bitdepth(imgarray)
+        save(frame_fname, imgarray, settings=settings,
+             description=description,
+             **pack_options(settings, run_data.bitdepth))
+        if variance is not None:
+            variance = grayscale_variance(variance, settings)
+            save(suffix_fname(frame_fname, "var"), variance,
+                 description=description)
+        del imgarray, variance
 
     # update run variables
     run_data.t_lastscan = t_scan
@@ -79,15 +402,8 @@ def do_scanningX(device_name, settings_dict):
     return imgarray
 
 def do_scanning(device_name, settings_dict):
-    sane.init()
-    scanner = sane.open(device_name)
-    if "mode" in settings_dict:
-        scanner.mode = settings_dict["mode"]
-    for (key, value) in settings_dict.iteritems():
-        setattr(scanner, key, value)
-    imgarray = scanner.arr_scan()
-    scanner.close()
-    sane.exit()
-    return imgarray
+    session = get_session(device_name)
+    session.configure(settings_dict)
+    return session.arr_scan()
 
 
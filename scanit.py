@@ -6,19 +6,21 @@ import collections
 
 import numpy as np
 import tifffile as TIFF
-import sane
 import click
 import toml
 
+import scanfunctions
+
 
 
 
 def quick_scan(settings = {}, test = False):
     """Make scan using first scanning device found by SANE driver.
     """
-    # init and find devices
-    sane.init()
-    devices = sane.get_devices(localOnly = True)
+    # init (once per process) and find devices
+    if not scanfunctions.driver_initialized():
+        scanfunctions.initialize_driver()
+    devices = scanfunctions.get_scanners(localOnly = True)
 
     if test:
         devices = [("test", "SANE", "SANE", "SANE")]
@@ -32,18 +34,11 @@ def quick_scan(settings = {}, test = False):
         return None
     dev_name = devices[0][0]
 
-    # open scanner
-    scanner = sane.open(dev_name)
-
-    # set options
-    if "mode" in settings:
-        scanner.mode = settings["mode"]
-    for (key, value) in settings.items():
-        setattr(scanner, key, value)
+    # reuse open device handle, if any, and set options
+    session = scanfunctions.get_session(dev_name)
+    session.configure(settings)
 
-    img = scanner.arr_scan()
-    scanner.close()
-    sane.exit()
+    img = session.arr_scan()
     return img    
 
 
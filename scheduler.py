@@ -0,0 +1,240 @@
+"""
+scheduler.py -- timed events on a monotonic clock
+
+A Scheduler holds a priority queue of timed events (power on, scan, power
+off, UI ticks...) and dispatches each to the callbacks subscribed to its
+kind when it comes due.  The run loop sleeps on a condition variable until
+the earliest deadline, or until an event is added or the scheduler is
+stopped, so nothing polls.  Run loops and UIs subscribe to the events
+they care about instead of each keeping their own timing loop.
+"""
+
+import datetime
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+# event kinds
+POWER_ON = "power_on"
+SCAN = "scan"
+POWER_OFF = "power_off"
+TICK = "tick"
+WAKE = "wake"
+
+
+class Event(object):
+    """A scheduled occurrence of kind at (monotonic) time t.
+
+    Periodic events (interval set) are rescheduled after each dispatch.
+    data holds whatever the scheduling code wants to pass to subscribers.
+    """
+    __slots__ = ("t", "seq", "kind", "data", "interval", "cancelled")
+
+    def __init__(self, t, seq, kind, data, interval = None):
+        self.t = t
+        self.seq = seq
+        self.kind = kind
+        self.data = data
+        self.interval = interval
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.t, self.seq) < (other.t, other.seq)
+
+    def __repr__(self):
+        return "Event({!r}, t={:.3f}, {!r})".format(self.kind, self.t, self.data)
+
+
+class Scheduler(object):
+    def __init__(self, clock = time.monotonic):
+        self.clock = clock
+        self.stopped = False
+        self._queue = []
+        self._seq = itertools.count()
+        self._subscribers = {}
+        self._cond = threading.Condition()
+
+    def subscribe(self, kind, callback):
+        """Call callback(event) for every event of kind -> callback.
+        """
+        self._subscribers.setdefault(kind, []).append(callback)
+        return callback
+
+    def unsubscribe(self, kind, callback):
+        self._subscribers.get(kind, []).remove(callback)
+
+    def at(self, t, kind, interval = None, **data):
+        """Schedule an event at monotonic time t -> Event.
+        """
+        with self._cond:
+            event = Event(t, next(self._seq), kind, data, interval)
+            heapq.heappush(self._queue, event)
+            self._cond.notify_all()
+        return event
+
+    def after(self, delay, kind, **data):
+        """Schedule an event delay secs from now -> Event.
+        """
+        return self.at(self.clock() + delay, kind, **data)
+
+    def every(self, interval, kind, delay = 0, **data):
+        """Schedule a periodic event, first after delay secs -> Event.
+
+        Periodic events don't keep run() going on their own.
+        """
+        return self.at(self.clock() + delay, kind, interval = interval, **data)
+
+    def cancel(self, event):
+        with self._cond:
+            event.cancelled = True
+            self._cond.notify_all()
+
+    def stop(self):
+        """Make run() return once the current dispatch is done.
+        """
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+
+    def next_event(self, kind = None):
+        """Earliest pending event (of kind, if given), or None.
+        """
+        with self._cond:
+            pending = [e for e in self._queue if not e.cancelled and
+                       (kind is None or e.kind == kind)]
+            return min(pending) if pending else None
+
+    def wall_time(self, t):
+        """Monotonic time t -> datetime, as best the clocks agree now.
+        """
+        return datetime.datetime.now() + datetime.timedelta(
+            seconds = t - self.clock())
+
+    def time_until(self, kind = None):
+        """Secs until the next event of kind, or None.
+        """
+        event = self.next_event(kind)
+        return None if event is None else max(0, event.t - self.clock())
+
+    def _pending_oneshots(self):
+        return any(not e.cancelled and e.interval is None for e in self._queue)
+
+    def _next_due(self, forever = False):
+        """Block until an event is due -> Event, or None when finished.
+        """
+        with self._cond:
+            while not self.stopped:
+                while self._queue and self._queue[0].cancelled:
+                    heapq.heappop(self._queue)
+                if not self._pending_oneshots():
+                    if not forever:
+                        return None
+                    if not self._queue:
+                        self._cond.wait()
+                        continue
+                delay = self._queue[0].t - self.clock()
+                if delay <= 0:
+                    event = heapq.heappop(self._queue)
+                    if event.interval is not None:
+                        # periodic events keep to their own grid, skipping
+                        # ticks missed while a long dispatch ran
+                        t_next = event.t + event.interval
+                        if t_next <= self.clock():
+                            t_next += event.interval * (1 + int(
+                                (self.clock() - t_next) // event.interval))
+                        heapq.heappush(self._queue, Event(
+                            t_next, next(self._seq),
+                            event.kind, event.data, event.interval))
+                    return event
+                self._cond.wait(delay)
+            return None
+
+    def dispatch(self, event):
+        for callback in list(self._subscribers.get(event.kind, [])):
+            callback(event)
+            if self.stopped:
+                break
+
+    def run(self, forever = False):
+        """Dispatch events as they come due -> False if stopped early.
+
+        Returns when stop() is called or, unless forever is True (e.g. for
+        a daemon that gets new work from elsewhere), when no one-shot
+        events are left.
+        """
+        while True:
+            event = self._next_due(forever)
+            if event is None:
+                return not self.stopped
+            self.dispatch(event)
+
+
+MISSED_POLICIES = ("skip", "compress", "shift")
+
+
+class Timetable(object):
+    """Time points at t0 + k * interval (k < nslots) on a monotonic clock.
+
+    Slot times are computed from the anchor, never from when the previous
+    scan happened to run, so overruns don't accumulate.  When a slot is
+    missed (we're ready more than tolerance secs after it) the policy says
+    what to do:
+
+        skip      drop missed slots and wait for the next one on the grid
+        compress  run the missed slot now, later slots stay on the grid
+        shift     run it now and move the whole grid later by the delay
+    """
+    def __init__(self, t0, interval, nslots, policy = "compress",
+                 tolerance = 1.0):
+        if policy not in MISSED_POLICIES:
+            raise ValueError("missed slot policy must be one of {}".format(
+                ", ".join(MISSED_POLICIES)))
+        self.t0 = t0
+        self.interval = interval
+        self.nslots = nslots
+        self.policy = policy
+        self.tolerance = tolerance
+        self.nskipped = 0
+
+    def planned(self, k):
+        return self.t0 + k * self.interval
+
+    def next_slot(self, k, now):
+        """Slot to run when slot k is next -> (slot, time to run it), or None
+        when the timetable is finished.
+        """
+        if k >= self.nslots:
+            return None
+        t = self.planned(k)
+        if now <= t + self.tolerance:
+            return k, t
+        if self.policy == "skip":
+            late = now - self.tolerance - t
+            k_next = k + int(math.ceil(late / self.interval)) if self.interval else k
+            self.nskipped += k_next - k
+            if k_next >= self.nslots:
+                return None
+            return k_next, self.planned(k_next)
+        if self.policy == "shift":
+            self.t0 += now - t
+        return k, now
+
+
+def wait(delay, on_tick = None, tick = 1, clock = time.monotonic):
+    """Block for delay secs, calling on_tick(secs remaining) every tick secs.
+
+    -> False if on_tick returned False (e.g. the user aborted), else True.
+    """
+    scheduler = Scheduler(clock)
+    t_end = scheduler.clock() + delay
+    scheduler.at(t_end, WAKE)
+    if on_tick is not None:
+        def ticked(event):
+            if on_tick(max(0, t_end - scheduler.clock())) is False:
+                scheduler.stop()
+        scheduler.subscribe(TICK, ticked)
+        scheduler.every(tick, TICK)
+    return scheduler.run()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+synthscanner.py -- a synthetic scanner for load testing and benchmarks
+
+Renders images of pinned colonies on agar plates at any resolution, depth
+and mode, a block of rows at a time, with configurable latency (time to
+first byte) and throughput.  It can stand in for a scanner in two ways:
+
+* SyntheticScanner has the same interface as python-sane device objects
+  (settable options, get_options, get_parameters, arr_scan, close).
+
+* Run as a script it mimics scanimage: it takes the same --option value
+  arguments (plus -l/-t/-x/-y geometry, --format pnm|tiff and -n, i.e.
+  --dont-scan) and writes the image to stdout.  unsane runs it in place of scanimage for devices
+  named "synthetic...", so the whole acquisition and write pipeline can be
+  exercised at production image sizes on a machine without scanners.
+
+Environment variables (inherited by the scanimage stand-in):
+
+    UNSCANNY_SYNTHETIC             number of synthetic devices to list
+    UNSCANNY_SYNTHETIC_LATENCY     seconds before the first row (default 0)
+    UNSCANNY_SYNTHETIC_THROUGHPUT  bytes/sec, 0 for unlimited (default 0)
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+
+SYNTHETIC = "synthetic"
+
+MM_PER_INCH = 25.4
+
+# bed sizes in mm (width, height)
+BEDS = {"Flatbed": (215.9, 297.2),
+        "TPU8x10": (203.2, 254.0)}
+
+# plate boxes in mm (x0, y0, x1, y1): plates.json's layout turned upright,
+# as plates.json is measured on a landscape scan, so all four plates fit on
+# the smallest bed.  synthetic-plates.json has them as regions at 300 dpi.
+DEFAULT_PLATES = [(6.6, 0.0, 86.7, 120.6),
+                  (101.6, 0.0, 181.7, 120.6),
+                  (6.6, 130.2, 86.7, 250.8),
+                  (101.6, 129.3, 181.7, 249.9)]
+
+PLATE_ROWS, PLATE_COLS = 8, 12      # 96 colonies per plate
+
+# bytes of image generated per block
+BLOCKSIZE = 2**22
+
+
+def synthetic_devices():
+    """Names of synthetic devices to list, per UNSCANNY_SYNTHETIC.
+    """
+    n = int(os.environ.get("UNSCANNY_SYNTHETIC", "0") or 0)
+    return ["{}:{}".format(SYNTHETIC, i) for i in range(n)]
+
+
+def is_synthetic(device):
+    return str(device).startswith(SYNTHETIC)
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default) or default)
+
+
+class SyntheticScanner(object):
+    """A fake SANE device producing plate images.
+
+    Options are plain attributes, as on python-sane devices.
+    """
+    def __init__(self, device_name = SYNTHETIC, latency = None,
+                 throughput = None, plates = DEFAULT_PLATES, seed = 0):
+        self.device_name = device_name
+        self.mode = "Gray"
+        self.resolution = 300
+        self.depth = 16
+        self.source = "TPU8x10"
+        self.tl_x = self.tl_y = 0.0
+        self.br_x = self.br_y = None
+        if latency is None:
+            latency = _env_float("UNSCANNY_SYNTHETIC_LATENCY", 0)
+        if throughput is None:
+            throughput = _env_float("UNSCANNY_SYNTHETIC_THROUGHPUT", 0)
+        self.latency = latency
+        self.throughput = throughput
+        self.plates = list(plates)
+        self.seed = seed
+        self.nscans = 0
+        self._colonies = self._pin_colonies()
+
+    # --- python-sane style interface ---
+
+    def get_options(self):
+        """Option descriptors, as python-sane's get_options() returns them.
+        """
+        width, height = BEDS["Flatbed"]
+        # (number, name, title, desc, type, unit, size, cap, constraint)
+        return [(1, "mode", "Mode", "", 3, 0, 0, 0, ["Gray", "Color"]),
+                (2, "resolution", "Resolution", "", 1, 4, 4, 0,
+                 [75, 150, 300, 600, 1200, 2400]),
+                (3, "depth", "Depth", "", 1, 0, 4, 0, [8, 16]),
+                (4, "source", "Source", "", 3, 0, 0, 0, list(BEDS)),
+                (5, "tl-x", "Top-left x", "", 2, 3, 4, 0, (0, width, 0)),
+                (6, "tl-y", "Top-left y", "", 2, 3, 4, 0, (0, height, 0)),
+                (7, "br-x", "Bottom-right x", "", 2, 3, 4, 0, (0, width, 0)),
+                (8, "br-y", "Bottom-right y", "", 2, 3, 4, 0, (0, height, 0))]
+
+    def get_parameters(self):
+        """-> (format, last_frame, (pixels_per_line, lines), depth, bytes_per_line)
+        """
+        height, width, nchannels = self.image_shape()
+        fmt = "color" if nchannels == 3 else "gray"
+        return (fmt, 1, (width, height), self.depth,
+                width * nchannels * self.depth // 8)
+
+    def start(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        pass
+
+    def arr_snap(self):
+        img = np.empty(self.shape(), self.dtype())
+        row = 0
+        for block in self.iter_blocks():
+            img[row:row + block.shape[0]] = block
+            row += block.shape[0]
+        return img
+
+    def arr_scan(self):
+        self.start()
+        return self.arr_snap()
+
+    # --- rendering ---
+
+    def area(self):
+        """Scan area in mm -> (x0, y0, x1, y1).
+        """
+        width, height = BEDS.get(self.source, BEDS["Flatbed"])
+        x1 = width if self.br_x is None else min(self.br_x, width)
+        y1 = height if self.br_y is None else min(self.br_y, height)
+        return self.tl_x, self.tl_y, x1, y1
+
+    def image_shape(self):
+        x0, y0, x1, y1 = self.area()
+        px = self.resolution / MM_PER_INCH
+        nchannels = 3 if str(self.mode).lower() == "color" else 1
+        return (max(1, int(round((y1 - y0) * px))),
+                max(1, int(round((x1 - x0) * px))), nchannels)
+
+    def shape(self):
+        height, width, nchannels = self.image_shape()
+        return (height, width, 3) if nchannels == 3 else (height, width)
+
+    def dtype(self):
+        return np.dtype(np.uint16 if int(self.depth) > 8 else np.uint8)
+
+    def _pin_colonies(self):
+        """Colony centres, sizes and densities (mm) on each plate.
+        """
+        rng = np.random.RandomState(self.seed)
+        colonies = []
+        for (x0, y0, x1, y1) in self.plates:
+            # the long side of the plate takes the long side of the grid
+            nrows, ncols = PLATE_ROWS, PLATE_COLS
+            if y1 - y0 > x1 - x0:
+                nrows, ncols = ncols, nrows
+            xpitch = (x1 - x0) / (ncols + 1)
+            ypitch = (y1 - y0) / (nrows + 1)
+            for i in range(nrows):
+                for j in range(ncols):
+                    if rng.rand() < 0.04:
+                        continue        # failed pin
+                    colonies.append((x0 + (j + 1) * xpitch + rng.normal(0, 0.2),
+                                     y0 + (i + 1) * ypitch + rng.normal(0, 0.2),
+                                     min(xpitch, ypitch) * rng.uniform(0.12, 0.22),
+                                     rng.uniform(0.3, 0.6)))
+        return np.array(colonies).reshape(-1, 4)
+
+    def render_rows(self, row0, nrows):
+        """Render rows row0:row0+nrows of the current scan -> array block.
+        """
+        height, width, nchannels = self.image_shape()
+        x0, y0, x1, y1 = self.area()
+        mm = MM_PER_INCH / self.resolution
+        ys = y0 + (np.arange(row0, row0 + nrows) + 0.5) * mm
+        xs = x0 + (np.arange(width) + 0.5) * mm
+        # transmitted light: bright bed, dimmer agar, dark colonies;
+        # reflected light is the reverse
+        transmitted = self.source != "Flatbed"
+        bed, agar, sign = (0.92, 0.72, -1) if transmitted else (0.04, 0.18, 1)
+        block = np.full((nrows, width), bed, np.float32)
+        for (px0, py0, px1, py1) in self.plates:
+            rows = (ys >= py0) & (ys < py1)
+            cols = (xs >= px0) & (xs < px1)
+            block[np.ix_(rows, cols)] = agar
+        growth = min(2.0, 0.6 + 0.05 * self.nscans)
+        for (cx, cy, radius, density) in self._colonies:
+            r = radius * growth
+            rows = np.nonzero(np.abs(ys - cy) < 3 * r)[0]
+            if not len(rows):
+                continue
+            cols = np.nonzero(np.abs(xs - cx) < 3 * r)[0]
+            if not len(cols):
+                continue
+            dy = (ys[rows] - cy)[:, None]
+            dx = (xs[cols] - cx)[None, :]
+            blob = np.exp(-(dx * dx + dy * dy) / (2 * r * r / 4))
+            block[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1] += \
+                sign * density * agar * blob.astype(np.float32)
+        rng = np.random.RandomState((self.seed + 7919 * self.nscans + row0)
+                                    % 2**32)
+        block += rng.standard_normal(block.shape).astype(np.float32) * 0.01
+        np.clip(block, 0, 1, out = block)
+        maxval = np.iinfo(self.dtype()).max
+        if nchannels == 3:
+            tint = np.array([1.0, 0.96, 0.82], np.float32)
+            block = block[:, :, None] * tint
+        return (block * maxval).astype(self.dtype())
+
+    def iter_blocks(self, blocksize = BLOCKSIZE):
+        """Generate the scan a block of rows at a time, paced to simulate
+        the configured latency and throughput.
+        """
+        height, width, nchannels = self.image_shape()
+        rowbytes = width * nchannels * self.dtype().itemsize
+        rows = max(1, blocksize // rowbytes)
+        t_start = time.monotonic()
+        if self.latency:
+            time.sleep(self.latency)
+        sent = 0
+        for row0 in range(0, height, rows):
+            nrows = min(rows, height - row0)
+            block = self.render_rows(row0, nrows)
+            sent += block.nbytes
+            if self.throughput:
+                t_due = t_start + self.latency + sent / self.throughput
+                delay = t_due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield block
+        self.nscans += 1
+
+
+# --- unsane.scan style interface ---
+
+def configure(scanner, settings):
+    """Apply scanimage style settings (tl-x or -l/-t/-x/-y style) to scanner.
+    """
+    for (key, value) in settings.items():
+        key = key.replace("-", "_")
+        if key in ("mode", "source"):
+            setattr(scanner, key, value)
+        elif key in ("resolution", "depth"):
+            setattr(scanner, key, int(value))
+        elif key in ("tl_x", "tl_y", "br_x", "br_y"):
+            setattr(scanner, key, float(value))
+    return scanner
+
+
+def scan(device, settings):
+    """Synthetic counterpart of unsane.scan -> image array.
+    """
+    return configure(SyntheticScanner(device), settings).arr_scan()
+
+
+def parse_args(argv):
+    """scanimage style argv -> (device, settings dict).
+    """
+    device, settings = SYNTHETIC, {}
+    geometry = {}
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == "-d":
+            device = args.pop(0)
+        elif arg == "-n":
+            settings["dont-scan"] = "yes"
+        elif arg in ("-l", "-t", "-x", "-y"):
+            geometry[arg] = float(args.pop(0))
+        elif arg.startswith("--"):
+            key = arg[2:]
+            if "=" in key:
+                key, value = key.split("=", 1)
+            elif args and not args[0].startswith("-"):
+                value = args.pop(0)
+            else:
+                value = "yes"
+            settings[key] = value
+    if "-l" in geometry or "-t" in geometry:
+        settings["tl-x"] = geometry.get("-l", 0.0)
+        settings["tl-y"] = geometry.get("-t", 0.0)
+    if "-x" in geometry:
+        settings["br-x"] = settings.get("tl-x", 0.0) + geometry["-x"]
+    if "-y" in geometry:
+        settings["br-y"] = settings.get("tl-y", 0.0) + geometry["-y"]
+    return device, settings
+
+
+def main(argv = None, out = None):
+    """Stand in for scanimage: write a synthetic scan to stdout.
+    """
+    device, settings = parse_args(sys.argv[1:] if argv is None else argv)
+    out = sys.stdout.buffer if out is None else out
+    if "dont-scan" in settings:
+        return 0
+    scanner = configure(SyntheticScanner(device), settings)
+    if settings.get("format", "pnm") == "tiff":
+        # TIFF needs a seekable file, so build it in memory
+        import io
+        import tifffile as TIFF
+        buf = io.BytesIO()
+        TIFF.imsave(buf, scanner.arr_scan())
+        out.write(buf.getvalue())
+        return 0
+    height, width, nchannels = scanner.image_shape()
+    maxval = np.iinfo(scanner.dtype()).max
+    out.write("{}\n{} {}\n{}\n".format("P6" if nchannels == 3 else "P5",
+                                       width, height, maxval).encode("ascii"))
+    for block in scanner.iter_blocks():
+        # PNM samples are big-endian
+        out.write(block.astype(block.dtype.newbyteorder(">")).tobytes())
+    out.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
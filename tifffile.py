@@ -1060,8 +1060,11 @@ class TiffWriter(object):
         if predictor:
             if datadtype.kind in 'iu':
                 predictortag = 2
-                predictor = imagecodecs.delta_encode
+                predictor = TIFF.PREDICTORS[2]
             elif datadtype.kind == 'f':
+                if imagecodecs is None:
+                    raise ValueError('floating point predictor requires '
+                                     'the imagecodecs package')
                 predictortag = 3
                 predictor = imagecodecs.floatpred_encode
             else:
@@ -6189,7 +6192,7 @@ class TIFF(object):
     def PREDICTORS():
         # Map PREDICTOR to predictor encode functions
         if imagecodecs is None:
-            return {None: identityfunc, 1: identityfunc}
+            return {None: identityfunc, 1: identityfunc, 2: delta_encode}
         return {
             None: imagecodecs.none_encode,
             1: imagecodecs.none_encode,
@@ -6200,7 +6203,7 @@ class TIFF(object):
     def UNPREDICTORS():
         # Map PREDICTOR to predictor decode functions
         if imagecodecs is None:
-            return {None: identityfunc, 1: identityfunc}
+            return {None: identityfunc, 1: identityfunc, 2: delta_decode}
         return {
             None: imagecodecs.none_decode,
             1: imagecodecs.none_decode,
@@ -8997,6 +9000,37 @@ def identityfunc(arg, *args, **kwargs):
     return arg
 
 
+def delta_encode(data, axis=-1, out=None):
+    """Horizontal differencing of integer data (numpy fallback).
+
+    >>> delta_encode(numpy.array([1, 3, 6], 'uint8'))
+    array([1, 2, 3], dtype=uint8)
+
+    """
+    data = numpy.asarray(data)
+    if out is None:
+        out = numpy.empty_like(data)
+    diff = numpy.diff(data, axis=axis)
+    first = [slice(None)] * data.ndim
+    first[axis] = slice(0, 1)
+    rest = list(first)
+    rest[axis] = slice(1, None)
+    out[tuple(rest)] = diff
+    out[tuple(first)] = data[tuple(first)]
+    return out
+
+
+def delta_decode(data, axis=-1, out=None):
+    """Undo horizontal differencing of integer data (numpy fallback).
+
+    >>> delta_decode(numpy.array([1, 2, 3], 'uint8'))
+    array([1, 3, 6], dtype=uint8)
+
+    """
+    data = numpy.asarray(data)
+    return numpy.cumsum(data, axis=axis, dtype=data.dtype, out=out)
+
+
 def nullfunc(*args, **kwargs):
     """Null function.
 
@@ -0,0 +1,74 @@
+"""
+tiffstream.py -- write a single TIFF image incrementally
+
+TIFF.TiffWriter wants the whole image as one numpy array.  Scans at high
+resolution and bit depth are big enough that we'd rather not hold them in
+memory, so StreamingTiffWriter reserves space for the image up front and
+lets the caller fill it in piece by piece as data arrives from the scanner.
+"""
+
+import numpy as np
+import tifffile as TIFF
+
+
+# default size of the blocks image data is moved around in; bounds memory
+CHUNKSIZE = 2**20
+
+
+class StreamingTiffWriter(TIFF.TiffWriter):
+    """TiffWriter that reserves one uncompressed image and fills it in chunks.
+
+    Usage:
+
+        with StreamingTiffWriter(fname, byteorder=">") as tif:
+            tif.begin(shape, dtype, description="...")
+            for block in blocks:
+                tif.write_rows(block)
+
+    The image data is stored uncompressed as one contiguous strip, so rows
+    can be appended in any block size and the result is readable by any
+    TIFF reader.
+    """
+    def begin(self, shape, dtype, **kwargs):
+        """Reserve space for an image of given shape and dtype.
+
+        Keyword arguments are passed on to TiffWriter.save.
+        """
+        dtype = np.dtype(dtype)
+        self.save(shape = shape, dtype = dtype, **kwargs)
+        self.shape = tuple(shape)
+        self.nbytes = int(np.prod(shape)) * dtype.itemsize
+        self.nwritten = 0
+        self.nrows = 0
+
+    def write(self, data):
+        """Append raw image bytes (already in the file's byte order).
+        """
+        n = memoryview(data).nbytes
+        if self.nwritten + n > self.nbytes:
+            raise ValueError("more image data than reserved by begin()")
+        self._fh.seek(self._dataoffset + self.nwritten)
+        self._fh.write(data)
+        self.nwritten += n
+        return n
+
+    def write_rows(self, block):
+        """Append a block of rows (numpy array, shape[1:] matching image).
+        """
+        block = np.asarray(block)
+        if block.shape[1:] != self.shape[1:]:
+            raise ValueError("row block shape {} doesn't match image {}".format(
+                block.shape, self.shape))
+        # convert to the file's byte order; no copy if already matching
+        block = np.ascontiguousarray(block, dtype = self._datadtype)
+        self.write(block)
+        self.nrows += block.shape[0]
+        return block.shape[0]
+
+    def complete(self):
+        return self.nwritten == self.nbytes
+
+    def close(self):
+        # remaining IFDs are appended at the current position, so move to EOF
+        self._fh.seek(0, 2)
+        TIFF.TiffWriter.close(self)
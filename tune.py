@@ -0,0 +1,178 @@
+"""
+tune.py -- benchmark scanner transfer options and save the best as a profile
+
+Transfer speed depends on scanimage's --buffer-size and on backend speed or
+quality options.  tune scans with each candidate combination, records time
+to first byte, total time and throughput, and can write the fastest to a
+profile file of its own.  The settings file is left alone, comments and
+all; pointing its "profile" entry at the profile file (profile =
+"epson-profile.toml") makes util.device_options and
+unsane.build_commandline apply it.
+"""
+
+import os
+import time
+import datetime
+import itertools
+
+import click
+import toml
+import yaml
+
+import unsane
+import watchdog
+
+
+DEFAULT_BUFFER_SIZES = (32, 128, 512, 2048)     # kB
+
+
+def candidates(buffer_sizes = DEFAULT_BUFFER_SIZES, options = None):
+    """Every combination of buffer size and backend option values.
+
+    options maps backend option names to lists of values to try.
+    """
+    options = options or {}
+    names = sorted(options)
+    profiles = []
+    for bufsize in buffer_sizes:
+        for values in itertools.product(*(options[name] for name in names)):
+            profile = {"buffer-size": int(bufsize)}
+            profile.update(zip(names, values))
+            profiles.append(profile)
+    return profiles
+
+
+def benchmark(device, settings, chunksize = unsane.CHUNKSIZE):
+    """Time one scan with settings -> dict of ttfb, seconds, nbytes, throughput.
+
+    The image is read from the pipe and discarded, so only acquisition and
+    transfer are timed.
+    """
+    settings = dict(settings, format = "pnm")
+    t_start = time.monotonic()
+    proc = unsane.open_scan(device, settings)
+    with watchdog.Watchdog(watchdog.scan_deadline(settings), proc.kill, device):
+        try:
+            first = proc.stdout.read(1)
+            ttfb = time.monotonic() - t_start
+            with open(os.devnull, "wb") as sink:
+                nbytes = len(first) + unsane.copy_stream(proc.stdout, sink,
+                                                         chunksize = chunksize)
+        except BaseException:
+            unsane.abort_scan(proc)
+            raise
+        unsane.finish_scan(proc)
+    seconds = time.monotonic() - t_start
+    return {"ttfb": round(ttfb, 3), "seconds": round(seconds, 3),
+            "nbytes": nbytes, "throughput": round(nbytes / seconds)}
+
+
+def tune(device, settings, profiles, repeats = 1, report = None):
+    """Benchmark each profile -> list of (profile, stats), fastest first.
+
+    Stats are from the fastest of repeats scans.  Profiles the device
+    rejects are skipped.  report, if given, is called with each result.
+    """
+    results = []
+    for profile in profiles:
+        trial = dict(settings, profile = profile)
+        try:
+            stats = min((benchmark(device, trial) for i in range(repeats)),
+                        key = lambda s: s["seconds"])
+        except (RuntimeError, ValueError) as e:
+            if report is not None:
+                report(profile, e)
+            continue
+        if report is not None:
+            report(profile, stats)
+        results.append((profile, stats))
+    results.sort(key = lambda r: r[1]["seconds"])
+    return results
+
+
+def save_profile(fname, profile, stats):
+    """Write profile (and its benchmark) to profile file fname (TOML).
+    """
+    benchmark = dict(stats, tuned = datetime.datetime.now().isoformat())
+    with open(fname, "w") as f:
+        toml.dump({"profile": profile, "profile_benchmark": benchmark}, f)
+
+
+def load_settings(fname):
+    """Scanner section of a YAML or TOML settings file -> dict.
+    """
+    with open(fname, "r") as f:
+        if os.path.splitext(fname)[1].lower() == ".toml":
+            return dict(toml.load(f)["scanner"])
+        return dict(yaml.safe_load(f)["scanner"])
+
+
+def option_value(text):
+    """Option value as typed -> int or float if it is a number, else str.
+
+    Numbers must go into the profile as numbers, or range and word-list
+    checks against the backend's constraints fail.  Words stay as typed
+    (YAML would turn "yes" into True).
+    """
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_option(text):
+    """'name=v1,v2' -> (name, [v1, v2]).
+    """
+    if "=" not in text:
+        raise click.BadParameter("expected name=value1,value2,...")
+    name, values = text.split("=", 1)
+    return name.strip(), [option_value(v.strip()) for v in values.split(",")
+                          if v.strip()]
+
+
+@click.command(name = "tune")
+@click.option("-d", "--device", required = True,
+              help = "Scanner device name")
+@click.option("-b", "--buffer-size", "buffer_sizes", multiple = True,
+              type = click.IntRange(1, 65536),
+              help = "scanimage buffer size (kB) to try; repeatable "
+                     "[default: {}]".format(", ".join(
+                         str(b) for b in DEFAULT_BUFFER_SIZES)))
+@click.option("-o", "--option", "options", multiple = True,
+              help = "Backend option values to try, e.g. speed=yes,no; "
+                     "repeatable")
+@click.option("-r", "--repeats", default = 1, show_default = True,
+              type = click.IntRange(1, 10),
+              help = "Scans per candidate (fastest counts)")
+@click.option("-w", "--write", "profile_file", default = None,
+              type = click.Path(dir_okay=False),
+              help = "Save the best profile to this TOML file")
+@click.argument("scanner_file",
+                type = click.Path(exists=True, dir_okay=False))
+def tune_cmd(scanner_file, device, buffer_sizes, options, repeats,
+             profile_file):
+    """Benchmark transfer options and save the fastest as a profile."""
+    settings = load_settings(scanner_file)
+    settings.pop("profile", None)
+    profiles = candidates(buffer_sizes or DEFAULT_BUFFER_SIZES,
+                          dict(parse_option(o) for o in options))
+
+    def report(profile, stats):
+        if isinstance(stats, Exception):
+            click.echo("{}: failed ({})".format(profile, stats))
+        else:
+            click.echo("{}: first byte {ttfb:.2f} s, total {seconds:.2f} s, "
+                       "{rate:.2f} MB/s".format(
+                           profile, rate = stats["throughput"] / 1e6, **stats))
+
+    results = tune(device, settings, profiles, repeats, report)
+    if not results:
+        raise click.ClickException("No candidate profile worked")
+    best, stats = results[0]
+    click.echo("Best: {}".format(best))
+    if profile_file:
+        save_profile(profile_file, best, stats)
+        click.echo("Profile saved to {}; to use it, set profile = \"{}\" in "
+                   "the scanner settings".format(profile_file, profile_file))
@@ -1,32 +1,388 @@
 import io
+import os
+import shlex
+import subprocess
+import sys
+import time
 
+import numpy as np
 import sarge
 import tifffile as TIFF
 
+import devices
+import imageops
+import synthscanner
+import tiffstream
+import util
+import watchdog
 
 
-test_settings = {"format":"tiff",
+# bytes read from the scanimage pipe per step; bounds peak memory
+CHUNKSIZE = tiffstream.CHUNKSIZE
+
+
+test_settings = {"format":"pnm",
                  "test-picture":"Color pattern",
                  "resolution":300,
                  "depth":16}
 
-def get_scanners():
-    scanners = str(sarge.get_stdout("scanimage -f '%d%n'")).splitlines()
-    return scanners
+def list_scanners():
+    """Enumerate scanners (slow: probes every backend).
+
+    Without the SANE tools installed only synthetic scanners are listed.
+    """
+    try:
+        scanners = str(sarge.get_stdout("scanimage -f '%d%n'")).splitlines()
+    except (ValueError, OSError):
+        # sarge raises ValueError when scanimage isn't on the PATH
+        scanners = []
+    return scanners + synthscanner.synthetic_devices()
+
+
+# one enumeration serves every lookup until a power event or the TTL
+registry = devices.DeviceRegistry(list_scanners)
+
+
+def get_scanners(refresh = False):
+    return registry.devices(refresh = refresh)
+
+
+def device_ready(device):
+    """True if device can be opened, i.e. it is powered up and not busy.
+    """
+    if synthscanner.is_synthetic(device):
+        return True
+    command = sarge.shell_format("scanimage -d {} -n", device)
+    p = sarge.run(command, stdout=sarge.Capture(), stderr=sarge.Capture())
+    return p.returncode == 0
+
+
+def scanners_probe(scanner_re, n = 1):
+    """Probe for util.poll_until -> matches once n devices match scanner_re.
+    """
+    def probe():
+        matches = list(filter(scanner_re.match, get_scanners(refresh = True)))
+        return matches if len(matches) >= n else None
+    return probe
+
+
+def settled_probe(scanner_re, settle):
+    """Probe for util.poll_until -> matches once some devices match
+    scanner_re and the matches haven't changed for settle secs.
+
+    For when we don't know how many scanners to expect: each takes its own
+    time to boot, so the first to show up doesn't mean they all have.
+    """
+    seen = {"matches": None, "since": None}
+    def probe():
+        matches = sorted(filter(scanner_re.match, get_scanners(refresh = True)))
+        now = time.monotonic()
+        if matches != seen["matches"]:
+            seen["matches"], seen["since"] = matches, now
+        return matches if matches and now - seen["since"] >= settle else None
+    return probe
+
+
+def idle_probe(devices):
+    """Probe for util.poll_until -> True once every device can be opened.
+    """
+    def probe():
+        return all(device_ready(device) for device in devices)
+    return probe
+
+
+def wait_for_scanners(scanner_re, timeout, n = 1, **kwargs):
+    """Poll device enumeration until n devices match scanner_re -> matches.
+
+    Returns as soon as the devices show up; an empty list means timeout
+    seconds passed without that happening.  Extra keyword arguments are
+    passed to util.poll_until.
+    """
+    return util.poll_until(scanners_probe(scanner_re, n), timeout,
+                           interval = 2, **kwargs) or []
+
+
+def wait_until_idle(devices, timeout, **kwargs):
+    """Poll until every device can be opened again -> True if so.
+    """
+    return bool(util.poll_until(idle_probe(devices), timeout, **kwargs))
+
+
+# scanimage takes scan area as left/top/width/height rather than corners
+GEOMETRY_KEYS = ("tl-x", "tl-y", "br-x", "br-y")
+
+
+def geometry2options(settingsdict):
+    if not all(key in settingsdict for key in GEOMETRY_KEYS):
+        return []
+    tlx, tly, brx, bry = (settingsdict[key] for key in GEOMETRY_KEYS)
+    return [sarge.shell_format("-l {} -t {} -x {} -y {}",
+                               round(tlx, 2), round(tly, 2),
+                               round(brx - tlx, 2), round(bry - tly, 2))]
 
 
 def settings2options(settingsdict):
-    options = [sarge.shell_format("--{} {}", key, val) for (key,val) in settingsdict.items()]
+    frontend = util.profile_options(settingsdict, frontend = True)
+    settingsdict = util.device_options(settingsdict)
+    options = [sarge.shell_format("--{} {}", key, val) for (key,val) in settingsdict.items()
+               if key not in GEOMETRY_KEYS]
+    options += geometry2options(settingsdict)
+    options += [sarge.shell_format("--{}={}", key, val)
+                for (key, val) in frontend.items()]
     return " ".join(options)
 
 
+def scanimage_program(scanner) -> str:
+    """scanimage, or the synthetic stand-in for synthetic devices.
+    """
+    if synthscanner.is_synthetic(scanner):
+        return sarge.shell_format("{} {}", sys.executable,
+                                  os.path.abspath(synthscanner.__file__))
+    return "scanimage"
+
+
 def build_commandline(scanner, settings) -> str:
-    return "scanimage -d {} {} ".format(scanner, settings2options(settings))
+    return "{} -d {} {} ".format(scanimage_program(scanner), scanner,
+                                 settings2options(settings))
+
+def scan(device, settings, timeout = None, out = None):
+    """Scan into memory -> image array.
+
+    With format "pnm" the pixels are read from the pipe straight into an
+    array, with no TIFF encode/decode round trip.  Pass the previous
+    result as out to reuse its buffer (if shape and dtype still match).
+    16-bit images come back big-endian, as scanimage sends them.
+    """
+    proc = open_scan(device, settings)
+    with watchdog.Watchdog(timeout, proc.kill, device):
+        try:
+            if settings.get("format") == "pnm":
+                img = read_pnm(proc.stdout, out)
+            else:
+                img = None
+                data = proc.stdout.read()
+        except BaseException:
+            abort_scan(proc)
+            raise
+        finish_scan(proc)
+    if img is not None:
+        return img
+    return TIFF.imread(io.BytesIO(data))
 
-def scan(device, settings):
+
+def open_scan(device, settings):
+    """Start scanimage with its image output on a pipe -> Popen object.
+    """
     command = build_commandline(device, settings)
-    c = sarge.capture_stdout(command)
-    return TIFF.imread(io.BytesIO(c.stdout.read()))
+    return subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE)
+
+
+def finish_scan(proc):
+    """Close the pipe and reap scanimage, raising if it failed.
+    """
+    proc.stdout.close()
+    retcode = proc.wait()
+    if retcode:
+        raise RuntimeError("scanimage exited with status {}".format(retcode))
+
+
+def abort_scan(proc):
+    """Kill and reap scanimage after reading its output failed.
+
+    Doesn't raise, so the error that got us here is the one reported.
+    """
+    proc.stdout.close()
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+
+
+def copy_stream(src, dst, nbytes=None, chunksize=CHUNKSIZE):
+    """Copy from binary stream src to dst in fixed-size chunks -> bytes copied.
+
+    If nbytes is given copy at most that many bytes, otherwise copy to EOF.
+    """
+    buf = memoryview(bytearray(chunksize))
+    total = 0
+    while nbytes is None or total < nbytes:
+        size = chunksize if nbytes is None else min(chunksize, nbytes - total)
+        n = src.readinto(buf[:size])
+        if not n:
+            break
+        dst.write(buf[:n])
+        total += n
+    return total
+
+
+def _pnm_token(stream):
+    """Read next whitespace delimited token from a PNM header.
+    """
+    token = b""
+    while True:
+        c = stream.read(1)
+        if not c:
+            raise ValueError("truncated PNM header")
+        if c == b"#":
+            while c not in (b"\n", b""):
+                c = stream.read(1)
+            continue
+        if c.isspace():
+            if token:
+                return token
+            continue
+        token += c
+
+
+def read_pnm_header(stream):
+    """Parse PNM (P5/P6) header from stream -> (shape, dtype).
+
+    The stream is left positioned at the first byte of pixel data.
+    Samples wider than 8 bits are big-endian, as per the PNM spec.
+    """
+    magic = _pnm_token(stream)
+    if magic not in (b"P5", b"P6"):
+        raise ValueError("unsupported PNM type {!r}".format(magic))
+    width, height, maxval = (int(_pnm_token(stream)) for i in range(3))
+    dtype = "u1" if maxval < 256 else ">u2"
+    if magic == b"P6":
+        return (height, width, 3), dtype
+    return (height, width), dtype
+
+
+def readinto_array(stream, arr):
+    """Fill contiguous array arr from stream, raising if it ends early.
+    """
+    view = memoryview(arr).cast("B")
+    got = 0
+    while got < len(view):
+        n = stream.readinto(view[got:])
+        if not n:
+            raise RuntimeError("scanimage output ended early")
+        got += n
+    return arr
+
+
+def read_pnm(stream, out = None):
+    """Read a PNM image from stream into an array -> array.
+
+    out is used as the buffer if it is a contiguous array of the image's
+    shape and dtype, otherwise a new array is allocated.
+    """
+    shape, dtype = read_pnm_header(stream)
+    if (out is None or out.shape != shape or out.dtype != np.dtype(dtype)
+            or not out.flags.c_contiguous):
+        out = np.empty(shape, dtype = dtype)
+    return readinto_array(stream, out)
+
+
+def read_row_blocks(stream, shape, dtype, rows):
+    """Generate blocks of at most rows image rows read from stream.
+
+    Each block is a view on one reused buffer, so consume (write) it before
+    asking for the next.
+    """
+    buf = np.empty((rows,) + tuple(shape[1:]), dtype = dtype)
+    nrows = shape[0]
+    done = 0
+    while done < nrows:
+        k = min(rows, nrows - done)
+        readinto_array(stream, buf[:k])
+        done += k
+        yield buf[:k]
+
+
+def scan_rows_to_file(device, settings, fname, description = None,
+                      chunksize = CHUNKSIZE, timeout = None):
+    """Acquire a scan in row blocks and append each block to a TIFF.
+
+    scanimage reads the SANE device and writes PNM to our pipe; rows are
+    read in blocks of about chunksize bytes and written as they arrive, so
+    the full frame is never resident in memory.  If the scan takes longer
+    than timeout secs scanimage is killed and watchdog.ScanTimeout raised.
+    If settings ask for grayscale, color rows are reduced as they arrive.
+    """
+    weights = imageops.grayscale_weights(settings)
+    settings = dict(settings)
+    settings["format"] = "pnm"
+    proc = open_scan(device, settings)
+    with watchdog.Watchdog(timeout, proc.kill, device):
+        try:
+            shape, dtype = read_pnm_header(proc.stdout)
+            rowbytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+            rows = max(1, chunksize // rowbytes)
+            if len(shape) != 3:
+                weights = None
+            # PNM samples are big-endian, so a big-endian TIFF takes the
+            # rows without any byte swapping
+            with tiffstream.StreamingTiffWriter(fname, byteorder=">") as tif:
+                tif.begin(shape[:2] if weights else shape, dtype,
+                          description = description)
+                for block in read_row_blocks(proc.stdout, shape, dtype, rows):
+                    if weights:
+                        block = imageops.to_grayscale(block, weights)
+                    tif.write_rows(block)
+        except BaseException:
+            abort_scan(proc)
+            raise
+        finish_scan(proc)
+    return fname
+
+
+def scan_to_file(device, settings, fname, raw = True, description = None,
+                 chunksize = CHUNKSIZE, timeout = None):
+    """Scan straight to a TIFF file without holding the image in memory.
+
+    If raw is True the TIFF produced by scanimage is written as-is.
+    Otherwise the scan is acquired in row blocks and written to a new TIFF
+    (so we can add our own description tag).  In either case peak memory is
+    bounded by chunksize rather than by the image size.
+    """
+    if not raw:
+        return scan_rows_to_file(device, settings, fname,
+                                 description = description,
+                                 chunksize = chunksize, timeout = timeout)
+    settings = dict(settings)
+    settings["format"] = "tiff"
+    proc = open_scan(device, settings)
+    with watchdog.Watchdog(timeout, proc.kill, device):
+        try:
+            with open(fname, "wb") as f:
+                copy_stream(proc.stdout, f, chunksize = chunksize)
+        except BaseException:
+            abort_scan(proc)
+            raise
+        finish_scan(proc)
+    return fname
 
 
+def scan_averaged(device, settings, passes, variance = False,
+                  chunksize = CHUNKSIZE, timeout = None):
+    """Average passes back-to-back scans -> (mean image, variance or None).
 
+    Each scan is folded into the accumulator row block by row block as it
+    arrives, so memory is one accumulator plus one block.  timeout applies
+    to each pass.
+    """
+    settings = dict(settings)
+    settings["format"] = "pnm"
+    accumulator = None
+    for i in range(passes):
+        proc = open_scan(device, settings)
+        with watchdog.Watchdog(timeout, proc.kill, device):
+            try:
+                shape, dtype = read_pnm_header(proc.stdout)
+                if accumulator is None:
+                    accumulator = imageops.FrameAccumulator(shape, dtype,
+                                                            variance)
+                rowbytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+                rows = max(1, chunksize // rowbytes)
+                row = 0
+                for block in read_row_blocks(proc.stdout, shape, dtype, rows):
+                    accumulator.add_rows(block, row)
+                    row += block.shape[0]
+                accumulator.end_frame()
+            except BaseException:
+                abort_scan(proc)
+                raise
+            finish_scan(proc)
+    return accumulator.mean(), accumulator.variance()
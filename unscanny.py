@@ -16,6 +16,7 @@ runit ->
 from __future__ import print_function, division
 import sys
 import threading
+import functools
 import time, datetime
 import textwrap
 import uuid
@@ -26,8 +27,14 @@ import click                   # library for building CLIs
 import pick                    # curses library for picking from lists
 
 import settings
+import imageops
 import scanfunctions
+import scheduler
 import uncursed
+import util
+from util import poll_until
+import watchdog
+import writer
 
 
 
@@ -68,6 +75,10 @@ class RunData(object):
         self.scanner_settings = scanner_settings
         self.power_settings = power_settings
         self.ct_nextscan = 0
+        self.timeouts = []
+        self.scan_times = []
+        self.bitdepth = imageops.BitDepthProbe()
+        self.effective_bits = None
         self._log = []
         self.t_start = None
         self.t_lastscan = None
@@ -81,6 +92,16 @@ class RunData(object):
     def log(self, entry):
         self._log.append(entry)
 
+    # the scan count under the name util.RunData's bookkeeping uses
+    @property
+    def nscans_completed(self):
+        return self.ct_nextscan
+
+    record_timeout = util.RunData.record_timeout
+    record_scan_time = util.RunData.record_scan_time
+    schedule_str = util.RunData.schedule_str
+    observe_bitdepth = util.RunData.observe_bitdepth
+
     def generate_id(self):
         UUID = str(uuid.uuid4())
         return UUID.split('-')[0]
@@ -115,10 +136,13 @@ class RunData(object):
         if self.t_lastscan is not None:
             endstr = "End time: {}".format(self.t_lastscan.isoformat()) 
         totalstr = "Completed scans: {}".format(self.ct_nextscan)
+        timeoutstr = "Scan timeouts: {}".format(len(self.timeouts))
+        bitstr = "Effective bit depth: {}".format(self.effective_bits)
         succstr = "Run successful: {}".format(str(self.successful))
         logstr = "Log:\n\t{}".format("\n\t".join(self._log))
         parts = [idstr, scanset, runset, startstr, endstr,
-                 totalstr, succstr, logstr]
+                 totalstr, timeoutstr, bitstr, succstr, self.schedule_str(),
+                 logstr]
         reportstr = "\n\n".join(parts)
         return reportstr
 
@@ -134,9 +158,12 @@ class RunData(object):
 
 def choose_scanner(test=False):
     """Query for available scanners and return users choice.
+
+    The chosen device is returned as a persistent ScannerSession.
     """
-    # initialize driver and get list of available scanners
-    scanfunctions.initialize_driver()
+    # initialize driver (once) and get list of available scanners
+    if not scanfunctions.driver_initialized():
+        scanfunctions.initialize_driver()
     scanners = scanfunctions.get_scanners(test = test)
     if not len(scanners):
         return None, None
@@ -146,7 +173,9 @@ def choose_scanner(test=False):
             """Up/Down arrow keys to select, Enter to accept."""
     choice, index = pick.pick(scanners, title)
     device_name = choice[0]
-    return choice, scanfunctions.open_scanner(device_name)
+    session = scanfunctions.get_session(device_name)
+    session.acquire()
+    return choice, session
     
 
 def delay_loop(screen, delay_in_mins):
@@ -163,32 +192,14 @@ def delay_loop(screen, delay_in_mins):
             uncursed.centered_xcoord(screen, txt),
             txt)
 
-    # figure out end time
-    t_now = datetime.datetime.now()
-    t_end = t_now + datetime.timedelta(minutes = delay_in_mins)
-    waitstr = HHMMSS(t_end - t_now)
-    
-    # set status bar
-    uncursed.set_status_bar(screen,
-            "Time until first scan cycle: {}".format(waitstr))
-    screen.refresh()
-
-    # delay loop
-    while datetime.datetime.now() < t_end:
-        time.sleep(1)
-
-        # update status bar
-        waitstr = HHMMSS(time_until(t_end))
-        uncursed.set_status_bar(screen,
+    def on_tick(remaining):
+        waitstr = HHMMSS(datetime.timedelta(seconds = remaining))
+        update_status_bar(screen,
                 "Time until first scan cycle: {}".format(waitstr))
-        screen.refresh()
-
         # check for abort key
-        c = screen.getch()
-        if c == ord("Q"):
-            return False
+        return screen.getch() != ord("Q")
 
-    return True
+    return scheduler.wait(delay_in_mins * 60, on_tick)
 
 
 def countdown_screen(screen, delay_in_secs, 
@@ -196,7 +207,7 @@ def countdown_screen(screen, delay_in_secs,
                      status_txt = None,
                      abort_key = "Q",
                      sleep_time = 0.25):
-    """ A curses loop for a delay screen.
+    """ A curses delay screen, redrawn every sleep_time secs.
     """
     screen.clear()
     curses.curs_set(0)
@@ -213,42 +224,77 @@ def countdown_screen(screen, delay_in_secs,
             uncursed.centered_xcoord(screen, main_txt),
             main_txt)
 
-    # figure out end time
-    t_now = datetime.datetime.now()
-    t_end = t_now + datetime.timedelta(seconds = delay_in_secs)
-    waitstr = HHMMSS(t_end - t_now)
-    
-    # set status bar
-    uncursed.set_status_bar(screen,
-            "{}: {}".format(status_txt, waitstr))
-    screen.refresh()
+    def on_tick(remaining):
+        waitstr = HHMMSS(datetime.timedelta(seconds = remaining))
+        update_status_bar(screen, "{}: {}".format(status_txt, waitstr))
+        # check for abort key
+        c = screen.getch()
+        return not (abort_key and c == ord(abort_key))
 
-    # delay loop
-    while datetime.datetime.now() < t_end:
-        time.sleep(sleep_time)
+    return scheduler.wait(delay_in_secs, on_tick, tick = sleep_time)
 
-        # update status bar
-        waitstr = HHMMSS(time_until(t_end))
-        uncursed.set_status_bar(screen,
-                "{}: {}".format(status_txt, waitstr))
-        screen.refresh()
 
-        # check for abort key
-        c = screen.getch()
-        if abort_key:
-            if c == ord(abort_key):
-                return False
+def update_status_bar(screen, txt):
+    uncursed.set_status_bar(screen, txt)
+    screen.refresh()
+
+
+def wait_for_scanner(screen, scanner, run_data, msg):
+    """ Poll until scanner responds after power on -> False if user aborted.
 
+    power_settings.on_delay is an upper bound on the wait, not a fixed delay.
+    """
+    on_delay = max(0, run_data.power_settings.on_delay)
+    t_end = time.monotonic() + on_delay
+    aborted = []
+
+    def check_abort():
+        update_status_bar(screen, "{}. At most {} secs remaining.".format(
+            msg, int(max(0, t_end - time.monotonic()))))
+        if screen.getch() == ord("Q"):
+            aborted.append(True)
+        return bool(aborted)
+
+    ready = poll_until(scanner.ready, on_delay, abort = check_abort)
+    if aborted:
+        return False
+    if not ready:
+        run_data.log("Scanner not ready {} secs after power on.".format(on_delay))
     return True
-    
-    
 
 
+# times a hung scan is retried, power cycling the scanner before each retry
+SCAN_RETRIES = 2
 
 
-def update_status_bar(screen, txt):
-    uncursed.set_status_bar(screen, txt)
-    screen.refresh()
+def scan_with_retry(screen, scanner, power_manager, run_data, scan_func):
+    """ Run scan_func, power cycling the scanner and retrying on a timeout.
+
+    -> False if the user aborted while waiting for the scanner.
+    """
+    outlet = run_data.power_settings.outlet
+    for attempt in range(SCAN_RETRIES + 1):
+        try:
+            scan_func(scanner, run_data)
+            return True
+        except watchdog.ScanTimeout as e:
+            run_data.record_timeout(scanner.device_name, e.timeout, attempt)
+            if attempt == SCAN_RETRIES:
+                break
+        update_status_bar(screen, "Scan timed out. Power cycling scanner...")
+        power_manager.power_off(outlet)
+        scanner.power_cycled()
+        time.sleep(5)
+        power_manager.power_on(outlet)
+        if not wait_for_scanner(screen, scanner, run_data,
+                                "Restarting hung scanner"):
+            return False
+    run_data.log("Scan {} lost after {} timeouts.".format(
+        run_data.ct_nextscan, SCAN_RETRIES + 1))
+    # keep to the schedule; the time point is lost, not the run
+    run_data.t_lastscan = datetime.datetime.now()
+    run_data.ct_nextscan += 1
+    return True
 
 
 def scanner_loop(screen, scanner, power_manager, run_data, scan_func = scanfunctions.scan):
@@ -271,83 +317,92 @@ def scanner_loop(screen, scanner, power_manager, run_data, scan_func = scanfunct
                                txt)
     update_status_bar(screen, "Pausing for power on...")
 
-    power_manager.power_on(run_data.power_settings.outlet)
-
-    for i in range(max(0, run_data.power_settings.on_delay)):
+    events = scheduler.Scheduler()
+    outlet = run_data.power_settings.outlet
+    on_delay = run_data.power_settings.on_delay
+    # power off between scans, if on delay less than interval between scans
+    cycle_power = on_delay < (run_data.interval * 60)
+    # scan k is due at t_start + k * interval, anchored at the first scan;
+    # run settings may set "missed" to skip, compress or shift
+    timetable = scheduler.Timetable(None, run_data.interval * 60,
+                                    run_data.nscans,
+                                    policy = getattr(run_data, "missed",
+                                                     "compress"))
+
+    def abort():
+        events.stop()
+
+    def on_power_on(event):
+        power_manager.power_on(outlet)
+        first = run_data.ct_nextscan == 0
+        if not wait_for_scanner(screen, scanner, run_data,
+                                "Waiting for scanner to initialize" if first
+                                else "Power on in progress"):
+            return abort()
+        if first:
+            timetable.t0 = events.clock()
+        # don't scan early just because the scanner booted quickly
+        slot = event.data.get("slot", 0)
+        events.at(timetable.planned(slot), scheduler.SCAN, slot = slot)
+
+    def on_scan(event):
+        slot = event.data["slot"]
+        run_data.record_scan_time(slot, events.wall_time(timetable.planned(slot)),
+                                  datetime.datetime.now())
+        if run_data.ct_nextscan == 0:
+            update_status_bar(screen, "Running first scan...")
+            run_data.t_start = datetime.datetime.now()
+            run_data.t_lastscan = None
+        else:
+            update_status_bar(screen, "Scanning...")
+        if not scan_with_retry(screen, scanner, power_manager, run_data,
+                               scan_func):
+            return abort()
+        events.after(0, scheduler.POWER_OFF, slot = slot)
+
+    def on_power_off(event):
+        if cycle_power:
+            power_manager.power_off(outlet)
+            scanner.power_cycled()
         update_status_bar(screen,
-                          "Waiting {} secs for scanner to initialize.".format(run_data.power_settings.on_delay - (i+1)))
-        time.sleep(1)   
-
-        # did we get the abort signal?
-        c = screen.getch()
-        if c == ord("Q"):
-            return False        
-
-    update_status_bar(screen, "Running first scan...")
-    
-    # Run first scan 
-    run_data.t_start = datetime.datetime.now()
-    run_data.t_lastscan = None
-    run_data.ct_nextscan = 0
-    run_data = scan_func(scanner, run_data)
-
-    # power off, if on delay less than interval between scans
-    if run_data.power_settings.on_delay < (run_data.interval * 60):  
-        power_manager.power_off(run_data.power_settings.outlet)
-
-
-    update_status_bar(screen, 
-                      "Scan {} at {}".format(run_data.ct_nextscan - 1,
-                                             run_data.t_lastscan.ctime()))
-    
-
-    # Run loop for remaining scans
-    while run_data.ct_nextscan < run_data.nscans:
-        t_nextscan = run_data.t_lastscan + \
-                     datetime.timedelta(minutes=run_data.interval) - \
-                     datetime.timedelta(seconds = run_data.power_settings.on_delay)
-
-        # run tasks in interval between scans
-        while datetime.datetime.now() < t_nextscan:
-            time.sleep(1)
-            # update status bar
-            waitstr = HHMMSS(time_until(t_nextscan))
+                          "Scan {} at {}".format(run_data.ct_nextscan - 1,
+                                                 run_data.t_lastscan.ctime()))
+        slot = event.data["slot"] + 1
+        if slot >= run_data.nscans:
+            return
+        # the next slot is ready once powered on, on_delay secs before it
+        now = events.clock() + on_delay
+        late = now - timetable.planned(slot)
+        nxt = timetable.next_slot(slot, now)
+        if late > timetable.tolerance:
+            run_data.log("Slot {} missed by {:.0f} secs (policy: {})".format(
+                slot, late, timetable.policy))
+        if nxt is not None:
+            events.at(timetable.planned(nxt[0]) - on_delay, scheduler.POWER_ON,
+                      slot = nxt[0])
+
+    def on_tick(event):
+        wait = events.time_until(scheduler.POWER_ON)
+        if wait is not None and run_data.t_lastscan is not None:
+            waitstr = HHMMSS(datetime.timedelta(seconds = wait))
             update_status_bar(screen,
                 "Scan {} was run at {}. Next scan cycle in {}.".format(
                     run_data.ct_nextscan - 1,
                     run_data.t_lastscan.ctime(),
                     waitstr))
+        # did we get the abort signal?
+        if screen.getch() == ord("Q"):
+            abort()
 
-            # did we get the abort signal?
-            c = screen.getch()
-            if c == ord("Q"):
-                return False
-
-        
-        power_manager.power_on(run_data.power_settings.outlet)
-        for i in range(max(0, run_data.power_settings.on_delay)):
-            update_status_bar(screen,
-                                    "Power on in progress. {} secs remaining.".format(run_data.power_settings.on_delay - (i+1)))
-            screen.refresh()
-            time.sleep(1)
-            # did we get the abort signal?
-            c = screen.getch()
-            if c == ord("Q"):
-                return False             
-
-        # update status bar to indicate scanning has begun
-        uncursed.set_status_bar(screen, "Scanning...")
-        screen.refresh()
-
-        # carry out scan
-        scan_func(scanner, run_data)
+    events.subscribe(scheduler.POWER_ON, on_power_on)
+    events.subscribe(scheduler.SCAN, on_scan)
+    events.subscribe(scheduler.POWER_OFF, on_power_off)
+    events.subscribe(scheduler.TICK, on_tick)
 
-        # power off
-        if run_data.power_settings.on_delay < (run_data.interval * 60):  
-            power_manager.power_off(run_data.power_settings.outlet)        
-        
-    return True  
-                
+    run_data.ct_nextscan = 0
+    events.after(0, scheduler.POWER_ON)
+    events.every(1, scheduler.TICK, delay = 1)
+    return events.run()
 
 
 
@@ -429,7 +484,7 @@ def _runit(scanner_file, run_file, power_file = None, test = False):
 
     # Apply settings to device
     run_data.scanner_settings.device_info = device_info
-    scanfunctions.apply_scanner_settings(scanner, run_data.scanner_settings)
+    scanner.configure(run_data.scanner_settings)
 
     # Confirm begin scanning
     if not click.confirm(
@@ -455,9 +510,21 @@ def _runit(scanner_file, run_file, power_file = None, test = False):
             return run_data
     
 
-    # enter scanner loop
-    run_data.successful = curses.wrapper(scanner_loop,
-                                         scanner, power_manager, run_data)
+    # enter scanner loop; images are written on a background thread so
+    # power-off and scheduling don't wait on disk
+    image_writer = writer.WriterQueue(
+        maxsize = run_data.run_settings.get("writer_queue", 2))
+    try:
+        run_data.successful = curses.wrapper(
+            scanner_loop, scanner, power_manager, run_data,
+            functools.partial(scanfunctions.scan, writer = image_writer))
+    finally:
+        click.echo("Writing {} queued scan(s)...".format(image_writer.pending()))
+        image_writer.close()
+        scanfunctions.close_sessions()
+    for (fname, err) in image_writer.errors:
+        run_data.successful = False
+        run_data.log("Failed to write {}: {}".format(fname, err))
 
     # generate log file
     report_file_name = run_data.base_fname() + ".report"
@@ -505,11 +572,13 @@ def runit(scanner_file, run_file, power_file, test):
     _runit(scanner_file, run_file, power_file, test)
 
 
-import powerfunctions, unsettings    
+import powerfunctions, unsettings, preview, tune
 cli.add_command(unsettings.setrun)
 cli.add_command(unsettings.setscanner)
 cli.add_command(runit)
 cli.add_command(powerfunctions.setpower)
+cli.add_command(preview.preview)
+cli.add_command(tune.tune_cmd)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+"""
+unscannyd.py -- one process driving every scanning run on a host
+
+The daemon owns the host's scanners and power managers.  Runs are submitted
+over a local Unix socket, as the same run/scanner/power settings (TOML or
+YAML) clickscanny reads, and are all scheduled from a single
+scheduler.Scheduler.  The device cache, the USB identity map, power manager
+sessions, the image writer and USB bus arbitration are shared by every run.
+
+The protocol is one JSON object per line each way:
+
+    {"cmd": "submit", "settings_file": "/data/exp1.toml", "scanner": "epson",
+     "delay": 0}                              -> {"ok": true, "run": "3f2a9c1e"}
+    {"cmd": "status"}                         -> {"ok": true, "runs": [...]}
+    {"cmd": "cancel", "run": "3f2a9c1e"}      -> {"ok": true}
+    {"cmd": "shutdown"}                       -> {"ok": true}
+
+Errors come back as {"ok": false, "error": "..."}.  Runs sharing the host
+should select their scanners with distinct "scanner" patterns.
+"""
+
+import os
+import re
+import json
+import socket
+import socketserver
+import threading
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import toml
+import yaml
+
+from util import RunSettings, ScannerSettings, PowerSettings, RunData
+import clickscanny
+import cycles
+import devices
+import scheduler
+import writer
+
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".unscanny",
+                              "unscannyd.sock")
+
+# options a submission may give, with their defaults (as for clickscanny)
+RUN_OPTIONS = {"delay": 0, "scanner": "epson", "nscanners": 1,
+               "maxretries": 3, "on_delay": 60, "reset_delay": 30,
+               "keep_raw": True, "missed": "compress", "basedir": None}
+
+# run states
+WAITING = "waiting"
+CYCLING = "cycling"
+FINISHED = "finished"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+
+def load_settings(fname):
+    """Run, scanner and power sections of a TOML or YAML file -> dict.
+    """
+    with open(fname, "r") as f:
+        if os.path.splitext(fname)[1].lower() == ".toml":
+            return toml.load(f)
+        return yaml.safe_load(f)
+
+
+class Run(object):
+    """A submitted run: its settings, RunData and place in the timetable.
+    """
+    def __init__(self, settings, options):
+        self.options = dict(RUN_OPTIONS)
+        self.options.update(options)
+        self.run = RunSettings.fromdict(settings["run"])
+        self.run.delay = self.options["delay"]
+        self.scanner = ScannerSettings(settings["scanner"])
+        self.power = PowerSettings.fromdict(settings["power"])
+        self.rundata = RunData(self.run, self.scanner, self.power)
+        if self.options["basedir"]:
+            self.rundata.basedir = self.options["basedir"]
+        self.id = self.rundata.UID
+        self.timetable = None
+        self.state = WAITING
+        self.next_event = None
+        self.policy = None
+        self.error = None
+
+    def status(self):
+        return {"run": self.id, "user": self.run.user,
+                "experiment": self.run.experiment, "state": self.state,
+                "scans": self.rundata.nscans_completed,
+                "nscans": self.run.nscans, "error": self.error}
+
+
+class Daemon(object):
+    """Schedules every submitted run's power/scan cycles.
+
+    Timing is done by one scheduler thread; each cycle (power on, wait for
+    the scanners, scan, power off) runs on a worker thread so runs on
+    different scanners proceed in parallel.
+    """
+    def __init__(self, max_cycles = 8, writer_queue_size = 4, per_bus = 1,
+                 max_jitter = devices.DEFAULT_MAX_JITTER):
+        self.events = scheduler.Scheduler()
+        self.devmap = devices.DeviceMap()
+        # one arbiter for all runs, since their scanners share the buses
+        self.arbiter = devices.BusArbiter(per_bus, max_jitter)
+        self.writer = writer.WriterQueue(maxsize = writer_queue_size)
+        self.cycles = ThreadPoolExecutor(max_workers = max_cycles,
+                                         thread_name_prefix = "cycle")
+        self.runs = {}
+        self._power_managers = {}
+        self._power_locks = {}
+        self._lock = threading.Lock()
+        self._nerrors = 0
+        self.events.subscribe(scheduler.POWER_ON, self.on_power_on)
+
+    # -- shared power sessions
+
+    def power_session(self, power):
+        """Shared (manager, lock) for the power strip in power settings.
+        """
+        key = (power.module, power.address, power.username)
+        with self._lock:
+            if key not in self._power_managers:
+                self._power_managers[key] = clickscanny.power_manager(power)
+                self._power_locks[key] = threading.Lock()
+            return self._power_managers[key], self._power_locks[key]
+
+    def power_on(self, power):
+        mgr, lock = self.power_session(power)
+        with lock:
+            clickscanny.power_on(power, mgr)
+
+    def power_off(self, power):
+        mgr, lock = self.power_session(power)
+        with lock:
+            clickscanny.power_off(power, mgr)
+
+    # -- runs
+
+    def submit(self, settings, options):
+        """Add a run, first cycle after its delay -> Run.
+        """
+        run = Run(settings, options)
+        if run.options["missed"] not in scheduler.MISSED_POLICIES:
+            raise ValueError("missed must be one of {}".format(
+                ", ".join(scheduler.MISSED_POLICIES)))
+        t_first = self.events.clock() + run.run.delay * 60
+        run.timetable = scheduler.Timetable(t_first, run.run.interval * 60,
+                                            run.run.nscans,
+                                            policy = run.options["missed"])
+        o = run.options
+        scanner_re = re.compile(o["scanner"], re.IGNORECASE)
+        run.policy = cycles.CyclePolicy(
+            run.rundata, run.timetable, scanner_re, self.devmap,
+            nscanners = o["nscanners"], maxretries = o["maxretries"],
+            on_delay = o["on_delay"], reset_delay = o["reset_delay"])
+        with self._lock:
+            self.runs[run.id] = run
+        run.next_event = self.events.at(t_first, scheduler.POWER_ON,
+                                        run = run.id, cycle = 0, slot = 0)
+        run.rundata.log("Submitted at {}".format(
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        return run
+
+    def cancel(self, run_id):
+        run = self.runs.get(run_id)
+        if run is None:
+            raise KeyError("no run {}".format(run_id))
+        if run.state in (FINISHED, CANCELLED, FAILED):
+            return
+        if run.next_event is not None:
+            self.events.cancel(run.next_event)
+        run.rundata.log("Cancelled")
+        # a cycle in progress finishes and then sees this
+        if run.state == WAITING:
+            self.finish(run, CANCELLED)
+        else:
+            run.state = CANCELLED
+
+    def status(self):
+        with self._lock:
+            runs = list(self.runs.values())
+        status = []
+        for run in runs:
+            s = run.status()
+            wait = None
+            if run.state == WAITING and run.next_event is not None:
+                wait = max(0, run.next_event.t - self.events.clock())
+            s["next_cycle_secs"] = wait
+            status.append(s)
+        return status
+
+    def on_power_on(self, event):
+        run = self.runs.get(event.data["run"])
+        if run is None or run.state != WAITING:
+            return
+        run.state = CYCLING
+        run.next_event = None
+        self.cycles.submit(self.cycle, run, event.data["cycle"],
+                           event.data["slot"])
+
+    def cycle(self, run, i, slot):
+        """One power/scan cycle of run, then schedule its next one.
+        """
+        o = run.options
+
+        def do_scan(devices, only, attempt):
+            return clickscanny.scan(
+                run.scanner, run.rundata, o["scanner"],
+                keep_raw = o["keep_raw"], nscanners = o["nscanners"],
+                device_names = devices, only = only, attempt = attempt,
+                queue = self.writer, arbiter = self.arbiter)
+
+        actions = {cycles.POWER_ON: lambda: self.power_on(run.power),
+                   cycles.POWER_OFF: lambda: self.power_off(run.power),
+                   cycles.SCAN: do_scan}
+        planned = self.events.wall_time(run.timetable.planned(slot))
+        try:
+            cycles.run(run.policy.cycle(slot, planned), actions)
+        except Exception as e:
+            run.rundata.log("Cycle {} failed: {}".format(i + 1, e))
+            run.error = str(e)
+            return self.finish(run, FAILED)
+        finally:
+            self.check_writer()
+        if run.state == CANCELLED:
+            return self.finish(run, CANCELLED)
+        self.schedule_next(run, i, slot)
+
+    def schedule_next(self, run, i, slot):
+        nxt = run.policy.next_slot(slot, self.events.clock())
+        if nxt is None:
+            return self.finish(run, FINISHED)
+        run.state = WAITING
+        run.next_event = self.events.at(nxt[1], scheduler.POWER_ON,
+                                        run = run.id, cycle = i + 1,
+                                        slot = nxt[0])
+
+    def check_writer(self):
+        """Log shared writer errors in the runs whose files they were.
+        """
+        with self._lock:
+            errors = self.writer.errors[self._nerrors:]
+            self._nerrors += len(errors)
+            # nothing reads the list of files written; don't let it grow
+            del self.writer.written[:]
+            runs = list(self.runs.values())
+        for (fname, e) in errors:
+            for run in runs:
+                if run.rundata.t_start is not None and \
+                        fname.startswith(run.rundata.base_fname()):
+                    run.rundata.log("Writing {} failed: {}".format(fname, e))
+
+    def finish(self, run, state):
+        """Mark run done and write its report next to its scans.
+        """
+        run.state = state
+        run.next_event = None
+        rundata = run.rundata
+        rundata.t_end = datetime.datetime.now()
+        rundata.successful = state == FINISHED
+        if rundata.t_start is None:
+            return
+        self.writer.drain()
+        self.check_writer()
+        logfile = rundata.base_fname() + ".log"
+        with open(logfile, "w") as f:
+            f.write(rundata.generate_report())
+        click.echo("Run {} {}; log file saved as: {}".format(run.id, state,
+                                                            logfile))
+
+    def handle(self, msg):
+        """Carry out one protocol message -> reply dict.
+        """
+        cmd = msg.get("cmd")
+        if cmd == "submit":
+            if "settings" in msg:
+                settings = msg["settings"]
+                basedir = "."
+            else:
+                fname = os.path.abspath(msg["settings_file"])
+                settings = load_settings(fname)
+                basedir = os.path.dirname(fname)
+            options = {key: msg[key] for key in RUN_OPTIONS if key in msg}
+            options.setdefault("basedir", basedir)
+            run = self.submit(settings, options)
+            return {"ok": True, "run": run.id}
+        if cmd == "status":
+            return {"ok": True, "runs": self.status()}
+        if cmd == "cancel":
+            self.cancel(msg["run"])
+            return {"ok": True}
+        if cmd == "shutdown":
+            self.shutdown()
+            return {"ok": True}
+        raise ValueError("unknown command {!r}".format(cmd))
+
+    def serve_forever(self):
+        """Dispatch events until shutdown, then wind up unfinished runs.
+        """
+        try:
+            self.events.run(forever = True)
+        finally:
+            self.cycles.shutdown(wait = True)
+            for run in list(self.runs.values()):
+                if run.state in (WAITING, CYCLING):
+                    run.rundata.log("Daemon shut down")
+                    self.finish(run, CANCELLED)
+            self.writer.close()
+
+    def shutdown(self):
+        self.events.stop()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Answers each JSON line on a connection with one JSON line.
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.daemon.handle(json.loads(line.decode("utf-8")))
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(reply, default = str) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.daemon = daemon
+
+
+def request(msg, path = DEFAULT_SOCKET):
+    """Send one message to a running daemon -> reply dict.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+        with s.makefile("rb") as f:
+            return json.loads(f.readline().decode("utf-8"))
+
+
+@click.group()
+@click.option("--socket", "socket_path", default = DEFAULT_SOCKET,
+              show_default = True, type = click.Path(dir_okay = False),
+              help = "Control socket")
+@click.pass_context
+def cli(ctx, socket_path):
+    """Host daemon driving every scanning run."""
+    ctx.obj = socket_path
+
+
+@cli.command()
+@click.option("--per-bus", default = 1, show_default = True,
+              type = click.IntRange(0, 16),
+              help = "Max scans at once per USB host controller (0 = no limit)")
+@click.option("--max-jitter", default = devices.DEFAULT_MAX_JITTER,
+              show_default = True, type = click.IntRange(0, 3600),
+              help = "Max secs a scan waits for its USB bus in a time point")
+@click.pass_obj
+def serve(socket_path, per_bus, max_jitter):
+    """Run the daemon in the foreground."""
+    if os.path.exists(socket_path):
+        try:
+            request({"cmd": "status"}, socket_path)
+            raise click.ClickException("A daemon is already listening on "
+                                       "{}".format(socket_path))
+        except (IOError, OSError):
+            os.remove(socket_path)
+    sockdir = os.path.dirname(socket_path)
+    if sockdir and not os.path.isdir(sockdir):
+        os.makedirs(sockdir)
+    daemon = Daemon(per_bus = per_bus, max_jitter = max_jitter)
+    server = Server(socket_path, daemon)
+    os.chmod(socket_path, 0o600)
+    listener = threading.Thread(target = server.serve_forever,
+                                name = "control", daemon = True)
+    listener.start()
+    click.echo("Listening on {}".format(socket_path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+
+
+@cli.command()
+@click.option("-d", "--delay", default = 0, show_default = True,
+              type = click.IntRange(0, 9999),
+              help = "Delay before first scan (mins)")
+@click.option("-s", "--scannerstr", default = "epson", show_default = True,
+              help = "String to match on to identify this run's scanners")
+@click.option("-n", "--nscanners", default = 1, show_default = True,
+              type = click.IntRange(0, 99),
+              help = "Number of matching scanners to drive at once (0 = all)")
+@click.option("--missed", default = "compress", show_default = True,
+              type = click.Choice(scheduler.MISSED_POLICIES),
+              help = "What to do with a scan slot missed because of an overrun")
+@click.option("--keep-raw/--no-keep-raw", default = True, show_default = True,
+              help = "Save scanner's TIFF as-is, rather than re-encoding")
+@click.argument("settings_file",
+                type = click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def submit(socket_path, settings_file, delay, scannerstr, nscanners, missed,
+           keep_raw):
+    """Submit a run (TOML or YAML run/scanner/power settings)."""
+    reply = request({"cmd": "submit",
+                     "settings_file": os.path.abspath(settings_file),
+                     "delay": delay, "scanner": scannerstr,
+                     "nscanners": nscanners, "missed": missed,
+                     "keep_raw": keep_raw}, socket_path)
+    if not reply["ok"]:
+        raise click.ClickException(reply["error"])
+    click.echo("Submitted run {}".format(reply["run"]))
+
+
+@cli.command()
+@click.pass_obj
+def status(socket_path):
+    """List runs and their progress."""
+    reply = request({"cmd": "status"}, socket_path)
+    for run in reply["runs"]:
+        wait = run["next_cycle_secs"]
+        click.echo("{run} {user}/{experiment}: {state}, {scans}/{nscans} "
+                   "scans{nxt}{err}".format(
+                       nxt = "" if wait is None else
+                             ", next cycle in {}".format(clickscanny.HHMMSS(
+                                 datetime.timedelta(seconds = wait))),
+                       err = "" if not run["error"] else
+                             " ({})".format(run["error"]),
+                       **run))
+
+
+@cli.command()
+@click.argument("run_id")
+@click.pass_obj
+def cancel(socket_path, run_id):
+    """Cancel a run after its current cycle."""
+    reply = request({"cmd": "cancel", "run": run_id}, socket_path)
+    if not reply["ok"]:
+        raise click.ClickException(reply["error"])
+
+
+@cli.command()
+@click.pass_obj
+def shutdown(socket_path):
+    """Stop the daemon once cycles in progress are done."""
+    request({"cmd": "shutdown"}, socket_path)
+
+
+if __name__ == "__main__":
+    cli()
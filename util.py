@@ -1,3 +1,4 @@
+import os
 import time, datetime
 import uuid
 from string import Formatter
@@ -5,6 +6,11 @@ from string import Formatter
 import dataclasses
 from dataclasses import dataclass
 
+import toml
+
+import imageops
+import regions
+
 
 
 def strfdelta(tdelta, fmt):
@@ -30,6 +36,100 @@ def HHMMSS(tdelta):
 
 
 
+# scanner settings that configure unscanny itself, not the scanner
+PIPELINE_KEYS = {"device_info", "regions", "regions_dpi", "roi", "roi_margin",
+                 "split_regions", "passes", "variance", "scan_timeout",
+                 "grayscale", "grayscale_weights", "pack", "frames",
+                 "profile", "profile_benchmark"}
+
+# profile options that belong to the scanimage frontend, not the device
+FRONTEND_KEYS = {"buffer-size"}
+
+
+def load_profile(fname):
+    """Tuned profile from a profile file written by tune.py -> dict.
+    """
+    with open(fname, "r") as f:
+        return dict(toml.load(f).get("profile") or {})
+
+
+def profile_options(settings, frontend = False):
+    """Options from the tuned profile (see tune.py) in settings -> dict.
+
+    settings["profile"] is the profile itself or the name of a profile
+    file.  Returns the device options, or with frontend = True the
+    scanimage frontend options such as buffer-size.
+    """
+    profile = settings.get("profile") or {}
+    if isinstance(profile, str):
+        profile = load_profile(profile)
+    return {key: val for (key, val) in profile.items()
+            if (key in FRONTEND_KEYS) == frontend}
+
+
+def device_options(settings):
+    """Scanner settings -> dict of options to send to the device.
+
+    Drops unscanny's own keys, adds device options from the tuned profile
+    (explicit settings take precedence) and, if hardware ROI is enabled,
+    the SANE geometry covering the plate regions (last, so it follows
+    source/mode).
+    """
+    options = {key: val for (key, val) in settings.items()
+               if key not in PIPELINE_KEYS}
+    for (key, val) in profile_options(settings).items():
+        options.setdefault(key, val)
+    options.update(regions.settings_geometry(settings))
+    return options
+
+
+def frame_settings(settings):
+    """Scanner settings -> list of (name, settings), one per frame of a cycle.
+
+    settings["frames"] is a list of overrides of the other settings, e.g.
+    a different source or resolution, each acquired in turn within one
+    power-on.  A frame's "name" (default F01, F02...) is added to its file
+    names.  Without frames there is a single frame named None.
+    """
+    base = {key: val for (key, val) in settings.items() if key != "frames"}
+    frames = settings.get("frames")
+    if not frames:
+        return [(None, base)]
+    result = []
+    for (i, frame) in enumerate(frames):
+        frame = dict(frame)
+        name = str(frame.pop("name", "F{:02d}".format(i + 1)))
+        merged = dict(base)
+        merged.update(frame)
+        result.append((name, merged))
+    return result
+
+
+def poll_until(probe, timeout, interval = 1, backoff = 1.5, max_interval = 10,
+               abort = None):
+    """Call probe() until it returns something truthy -> result, or None.
+
+    The wait between calls starts at interval seconds and grows by a factor
+    of backoff up to max_interval.  timeout is a ceiling, not a fixed delay:
+    we return as soon as the probe succeeds.  If given, abort() is checked
+    about once a second and polling stops (returning None) when it is true.
+    """
+    t_end = time.monotonic() + timeout
+    while True:
+        result = probe()
+        if result:
+            return result
+        t_now = time.monotonic()
+        if t_now >= t_end:
+            return None
+        t_next = min(t_now + interval, t_end)
+        while time.monotonic() < t_next:
+            time.sleep(min(1, max(0, t_next - time.monotonic())))
+            if abort is not None and abort():
+                return None
+        interval = min(interval * backoff, max_interval)
+
+
 @dataclass
 class Settings:
     def __str__(self):
@@ -55,6 +155,11 @@ class RunSettings(Settings):
 class ScannerSettings(Settings):
     settings: dict
 
+    def __post_init__(self):
+        # a bad scan area should stop the run before it starts, not mid-run
+        for (name, settings) in frame_settings(self.settings):
+            regions.settings_geometry(settings)
+
     def __str__(self):
         s = ""
         for (key, val) in self.settings.items():
@@ -89,6 +194,10 @@ class RunData(object):
         self.t_lastscan = None
         self.t_end = None
         self.nscans_completed = 0
+        self.timeouts = []
+        self.scan_times = []
+        self.bitdepth = imageops.BitDepthProbe()
+        self.effective_bits = None
         self.successful = False
         self.basedir = "."
         self.UID = self._generate_id()
@@ -96,16 +205,50 @@ class RunData(object):
     def log(self, entry):
         self._log.append(entry)
 
+    def record_timeout(self, device, timeout, attempt = 0):
+        """Note a scan that hit its deadline, in timeouts and in the log.
+        """
+        t_now = datetime.datetime.now()
+        self.timeouts.append({"time": t_now, "scan": self.nscans_completed,
+                              "device": device, "timeout": timeout,
+                              "attempt": attempt})
+        self.log("{}: scan {} timed out on {} after {:.0f} secs (attempt {})".format(
+            t_now.strftime("%H:%M:%S"), self.nscans_completed, device,
+            timeout, attempt + 1))
+
+    def record_scan_time(self, slot, planned, actual):
+        """Note when scan slot was planned and when it actually ran.
+        """
+        self.scan_times.append({"scan": self.nscans_completed, "slot": slot,
+                                "planned": planned, "actual": actual})
+
+    def schedule_str(self):
+        lines = ["{:4d}  slot {:4d}  planned {}  actual {}  ({:+.1f} s)".format(
+                    t["scan"], t["slot"], t["planned"].strftime("%Y-%m-%d %H:%M:%S"),
+                    t["actual"].strftime("%H:%M:%S"),
+                    (t["actual"] - t["planned"]).total_seconds())
+                 for t in self.scan_times]
+        return "Scan times:\n\t{}".format("\n\t".join(lines))
+
+    def observe_bitdepth(self, img):
+        """Use img towards the run's effective bit depth; log it once known.
+        """
+        if self.bitdepth.observe(img):
+            self.effective_bits = self.bitdepth.bits
+            self.log("Effective bit depth: {} of {} bits (low bit {})".format(
+                self.bitdepth.bits, self.bitdepth.itembits,
+                self.bitdepth.lowbit))
+
     def _generate_id(self):
         UUID = str(uuid.uuid4())
         return UUID.split('-')[0]
 
     def base_fname(self):
-        """ Base filename for run.
+        """ Base filename for run, in basedir.
         """
-        return "{}-{}-{}-{}".format(
+        return os.path.normpath(os.path.join(self.basedir, "{}-{}-{}-{}".format(
             self.t_start.strftime("%Y-%m-%d"),
-            self.run_settings.user, self.run_settings.experiment, self.UID)
+            self.run_settings.user, self.run_settings.experiment, self.UID)))
 
     def current_fname(self, timept = None):
         """ Appropriate filename for current stage of run.
@@ -117,6 +260,11 @@ class RunData(object):
                                      self.nscans_completed,
                                      timestr)
 
+    def device_fname(self, index, timept = None):
+        """ Filename for scanner number index when several are driven at once.
+        """
+        return "{}-S{:02d}".format(self.current_fname(timept), index + 1)
+
     def settings_str(self):
         run, scan, power = self.run_settings, self.scanner_settings, self.power_settings
         s = "SETTINGS:\n\n"
@@ -143,10 +291,13 @@ class RunData(object):
         if self.t_lastscan is not None:
             endstr = "End time: {}".format(self.t_lastscan.isoformat()) 
         totalstr = "Completed scans: {}".format(self.nscans_completed)
+        timeoutstr = "Scan timeouts: {}".format(len(self.timeouts))
+        bitstr = "Effective bit depth: {}".format(self.effective_bits)
         succstr = "Run successful: {}".format(str(self.successful))
         logstr = "Log:\n\t{}".format("\n\t".join(self._log))
         parts = [title, idstr, setstr, startstr, endstr,
-                 totalstr, succstr, logstr]
+                 totalstr, timeoutstr, bitstr, succstr, self.schedule_str(),
+                 logstr]
         reportstr = "\n\n".join(parts)
         return reportstr
 
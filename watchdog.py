@@ -0,0 +1,129 @@
+"""
+watchdog.py -- deadlines for scans
+
+A hung scanner otherwise blocks the run forever, silently losing every
+later time point.  Each scan gets a deadline estimated from the amount of
+data it should produce; if it isn't done by then the scan is killed
+(scanimage) or cancelled (SANE) and ScanTimeout is raised so the caller
+can power cycle the scanner and retry.
+"""
+
+import threading
+
+import util
+
+
+# worst case sustained scanner -> host transfer rate, bytes/sec
+MIN_THROUGHPUT = 1e6
+
+# secs allowed on top of the transfer for lamp warm up, calibration etc.
+BASE_TIMEOUT = 120
+
+# full bed, mm, when settings give no geometry
+DEFAULT_AREA = (215.9, 297.2)
+
+
+class ScanTimeout(RuntimeError):
+    def __init__(self, device, timeout):
+        RuntimeError.__init__(self, "scan on {} took more than {:.0f} secs".format(
+            device, timeout))
+        self.device = device
+        self.timeout = timeout
+
+
+def scan_bytes(settings):
+    """Estimated size in bytes of one scan with settings.
+    """
+    options = util.device_options(settings)
+    if all(key in options for key in ("tl-x", "tl-y", "br-x", "br-y")):
+        width = options["br-x"] - options["tl-x"]
+        height = options["br-y"] - options["tl-y"]
+    else:
+        width, height = DEFAULT_AREA
+    px = float(settings.get("resolution", 300)) / 25.4
+    nchannels = 3 if str(settings.get("mode", "Gray")).lower() == "color" else 1
+    nbytes = 2 if int(settings.get("depth", 8)) > 8 else 1
+    return width * px * height * px * nchannels * nbytes
+
+
+def scan_deadline(settings):
+    """Secs to allow for one scan (one pass) with settings.
+
+    settings["scan_timeout"], if given, overrides the estimate.
+    """
+    if settings.get("scan_timeout"):
+        return float(settings["scan_timeout"])
+    return BASE_TIMEOUT + scan_bytes(settings) / MIN_THROUGHPUT
+
+
+class Watchdog(object):
+    """Call on_timeout() unless the with block finishes within timeout secs.
+
+    If the watchdog fired and the block failed, ScanTimeout is raised on
+    leaving it (whatever the block itself raised as a result of being
+    killed).  A block that got to the end is never failed, even if the
+    timer went off as it did: its scan is complete.  A timeout of None
+    disables the watchdog.
+    """
+    def __init__(self, timeout, on_timeout, device = None):
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.device = device
+        self.fired = False
+        self._done = False
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _fire(self):
+        # under the lock so a block can't finish half way through the kill
+        with self._lock:
+            if self._done:
+                return
+            self.fired = True
+            self.on_timeout()
+
+    def __enter__(self):
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            self._done = True
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.fired and exc_type is not None:
+            raise ScanTimeout(self.device, self.timeout) from exc_value
+
+
+def call_with_deadline(func, timeout, cancel = None, device = None):
+    """Return func(), or call cancel() and raise ScanTimeout after timeout secs.
+
+    func runs on a daemon thread, so a call wedged in the driver can't keep
+    the process alive; it is abandoned once cancel() has been tried.
+    """
+    if not timeout:
+        return func()
+    result = {}
+
+    def run():
+        try:
+            result["value"] = func()
+        except BaseException as e:
+            result["error"] = e
+
+    worker = threading.Thread(target = run, name = "scan", daemon = True)
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        if cancel is not None:
+            try:
+                cancel()
+            except Exception:
+                pass
+        raise ScanTimeout(device, timeout)
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
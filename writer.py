@@ -0,0 +1,215 @@
+"""
+writer.py -- save scans on a background thread
+
+Encoding and writing a large TIFF takes long enough that the scan loop
+shouldn't have to wait for it before powering the scanner off and
+scheduling the next cycle.  WriterQueue hands images off to a dedicated
+writer thread through a bounded queue.
+"""
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as TIFF
+
+import imageops
+import tiffstream
+from regions import pixel_regions
+
+
+def save_image(fname, img, **kwargs):
+    """Write img as TIFF.
+    """
+    TIFF.imsave(fname, img, **kwargs)
+    return fname
+
+
+# deflate level for packed storage
+PACK_LEVEL = 6
+
+
+def pack_options(settings, bitdepth = None):
+    """TIFF.imsave keyword arguments for packed storage -> dict.
+
+    settings["pack"] true always packs; "auto" packs once bitdepth (an
+    imageops.BitDepthProbe) has settled and shows samples use fewer bits
+    than they are stored in.  Packing is horizontal differencing (TIFF
+    predictor 2) followed by deflate: neighbouring pixels of a scan differ
+    by little, so the differences need few bits, and deflate takes out
+    those plus the unused high bits.  tifffile reads the result
+    transparently.  Pure noise gains least, about 15% at 12 of 16 bits.
+    """
+    mode = (settings or {}).get("pack")
+    if not mode:
+        return {}
+    if mode == "auto" and (bitdepth is None or not bitdepth.settled or
+                           not bitdepth.packable()):
+        return {}
+    return {"compress": PACK_LEVEL, "predictor": True}
+
+
+def suffix_fname(fname, name):
+    base, ext = os.path.splitext(fname)
+    return "{}-{}{}".format(base, name, ext)
+
+
+def save_region(fname, img, name, offset, dpi = None, description = None,
+                chunksize = tiffstream.CHUNKSIZE, **pack):
+    """Write a region (a view on the full scan) to its own TIFF.
+
+    Rows are copied out of the view a block at a time, so no full-size copy
+    of the region is made.  The region name goes in the PageName tag and
+    its offset in the full scan in XPosition/YPosition (as inches, along
+    with the scan resolution) and in the description.  Given pack_options,
+    the region is packed instead, which needs a copy of it.
+    """
+    x0, y0 = offset
+    desc = "Region: {}; Offset: {},{}".format(name, x0, y0)
+    if description:
+        desc = "{}; {}".format(description, desc)
+    extratags = [(285, "s", 0, name, True)]
+    kwargs = {}
+    if dpi:
+        extratags += [(286, "2I", 1, (x0, dpi), True),
+                      (287, "2I", 1, (y0, dpi), True)]
+        kwargs["resolution"] = (dpi, dpi)
+    if pack:
+        TIFF.imsave(fname, np.ascontiguousarray(img), description = desc,
+                    extratags = extratags, **dict(kwargs, **pack))
+        return fname
+    rowbytes = max(1, img[:1].nbytes)
+    rows = max(1, chunksize // rowbytes)
+    with tiffstream.StreamingTiffWriter(fname) as tif:
+        tif.begin(img.shape, img.dtype, description = desc,
+                  extratags = extratags, **kwargs)
+        for i in range(0, img.shape[0], rows):
+            tif.write_rows(img[i:i+rows])
+    return fname
+
+
+def save_regions(fname, img, settings, description = None, **pack):
+    """Save one TIFF per named region of img, in parallel -> list of fnames.
+
+    pack is pack_options for the region files.
+    """
+    dpi = settings.get("resolution")
+    regions = pixel_regions(settings, img.shape)
+    with ThreadPoolExecutor(max_workers = max(1, len(regions))) as pool:
+        futures = [pool.submit(save_region, suffix_fname(fname, name),
+                               img[y0:y1, x0:x1], name, (x0, y0), dpi,
+                               description, **pack)
+                   for (name, (x0, y0, x1, y1)) in regions.items()
+                   if x1 > x0 and y1 > y0]
+    return [future.result() for future in futures]
+
+
+def save_scan(fname, img, settings = None, **kwargs):
+    """Save stage for a scan -> list of files written.
+
+    Writes the full image and, if the scanner settings have split_regions
+    set, one TIFF per plate region as well, packed like the full image.
+    If settings ask for grayscale, RGB images are reduced to a single plane
+    first.
+    """
+    settings = settings or {}
+    weights = imageops.grayscale_weights(settings)
+    if weights is not None and img.ndim == 3 and img.shape[2] == 3:
+        img = imageops.to_grayscale(img, weights)
+    fnames = [save_image(fname, img, **kwargs)]
+    if settings.get("split_regions") and settings.get("regions"):
+        pack = {key: kwargs[key] for key in ("compress", "predictor")
+                if key in kwargs}
+        fnames += save_regions(fname, img, settings, kwargs.get("description"),
+                               **pack)
+    return fnames
+
+
+def split_file(fname, settings, description = None, **pack):
+    """Split an already written scan into per-region TIFFs -> list of fnames.
+
+    The scan is memory-mapped when possible rather than read into memory.
+    pack is pack_options for the region files.
+    """
+    try:
+        img = TIFF.memmap(fname, mode = "r")
+    except ValueError:
+        img = TIFF.imread(fname)
+    return save_regions(fname, img, settings, description, **pack)
+
+
+class WriterQueue(object):
+    """A bounded queue of images with a dedicated writer thread.
+
+    maxsize bounds the number of images held in memory waiting to be
+    written.  When the queue is full put() blocks (block=True) for up to
+    timeout seconds and then raises queue.Full, providing backpressure on
+    the scan loop rather than unbounded memory growth.
+    """
+    def __init__(self, maxsize = 2, block = True, timeout = None,
+                 save_func = save_scan):
+        self.block = block
+        self.timeout = timeout
+        self.save_func = save_func
+        self.written = []
+        self.errors = []
+        self._queue = queue.Queue(maxsize = maxsize)
+        self._closed = False
+        self._thread = threading.Thread(target = self._run,
+                                        name = "tiff-writer", daemon = True)
+        self._thread.start()
+
+    def put(self, fname, img, **kwargs):
+        """Queue img to be saved as fname; kwargs go to save_func.
+        """
+        if self._closed:
+            raise RuntimeError("writer queue is closed")
+        self._queue.put((fname, img, kwargs), self.block, self.timeout)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                fname, img, kwargs = item
+                try:
+                    self.written.append(self.save_func(fname, img, **kwargs))
+                except Exception as e:
+                    self.errors.append((fname, e))
+            finally:
+                self._queue.task_done()
+
+    def drain(self):
+        """Block until every queued image has been written.
+        """
+        self._queue.join()
+
+    def close(self, discard = False):
+        """Stop accepting images, write what is queued and stop the thread.
+
+        If discard is True, images not yet being written are dropped.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if discard:
+            try:
+                while True:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+            except queue.Empty:
+                pass
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()